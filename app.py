@@ -1,15 +1,42 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from datetime import datetime, date, timedelta
 from flask_session import Session
 import os
 from datetime import datetime
 from dotenv import load_dotenv
-from sqlalchemy import func
+from sqlalchemy import event, func, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import Pool
+from sqlalchemy.schema import CreateIndex
 from werkzeug.utils import secure_filename
+from collections import Counter, OrderedDict, defaultdict, deque
 import cloudinary
 import cloudinary.uploader
+import atexit
+import bisect
+import click
+import contextvars
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import math
+import mimetypes
+import numpy as np
+import queue
+import random
+import re
+import shutil
+import signal
+import socket
+import tempfile
+import threading
+import time
+import traceback
+import unicodedata
 load_dotenv()
 
 app = Flask(__name__, template_folder='Templates')
@@ -63,7 +90,36 @@ class Explorador(db.Model):
     segundo_apellido = db.Column(db.String(50))
     fecha_nacimiento = db.Column(db.Date)
     telefono = db.Column(db.String(20))
-    preferencias = db.Column(db.String(200))
+    preferencias = db.Column(db.String(200))          # texto legible, p. ej. "Comida, Ocio"
+    preferencias_mask = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)  # bit i = PREFERENCIAS[i]
+
+    preferencias_explorador = db.relationship('ExploradorPreferencia', backref='explorador', cascade='all, delete-orphan')
+    # Al borrar el explorador sus visitas quedan anónimas y sus sesiones de visita se eliminan
+    visitas = db.relationship('Visita', backref='explorador')
+    sesiones_visita = db.relationship('SesionVisita', cascade='all, delete-orphan')
+
+# Catálogo de preferencias: la posición es el id y el bit en Explorador.preferencias_mask
+PREFERENCIAS = ['Comida', 'Deportes', 'Ocio', 'Arte y Cultura', 'Naturaleza', 'Compras', 'Hospedaje']
+SINONIMOS_PREFERENCIA = {
+    'cultura': 'Arte y Cultura',
+    'arte': 'Arte y Cultura',
+    'deporte': 'Deportes',
+    'gastronomia': 'Comida',
+    'entretenimiento': 'Ocio',
+}
+
+class Preferencia(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    nombre = db.Column(db.String(50), unique=True, nullable=False)
+
+class ExploradorPreferencia(db.Model):
+    __tablename__ = 'explorador_preferencia'
+    __table_args__ = (
+        db.Index('ix_explorador_preferencia_pref', 'preferencia_id', 'explorador_id'),
+    )
+
+    explorador_id = db.Column(db.Integer, db.ForeignKey('explorador.id'), primary_key=True)
+    preferencia_id = db.Column(db.Integer, db.ForeignKey('preferencia.id'), primary_key=True)
 
 class Emprendedor(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -90,10 +146,22 @@ class Empresa(db.Model):
     url = db.Column(db.String(200))
     rango_precios = db.Column(db.String(50))          # nuevo: ejemplo "$ - $$ - $$$"
     imagen_filename = db.Column(db.String(200))       # nuevo: nombre de archivo en static/uploads/
+    latitud = db.Column(db.Float)                     # coordenadas para búsqueda "cerca de mí"
+    longitud = db.Column(db.Float)
     
     emprendedor_id = db.Column(db.Integer, db.ForeignKey('emprendedor.id'))
     visitas = db.relationship('Visita', backref='empresa', lazy=True)
     favoritos = db.relationship('Favorito', backref='empresa', lazy=True)  # relación
+    sesiones_visita = db.relationship('SesionVisita', back_populates='empresa', cascade='all, delete-orphan')
+    tendencia = db.relationship('TendenciaEmpresa', uselist=False, cascade='all, delete-orphan')
+
+class TendenciaEmpresa(db.Model):
+    # Puntaje de tendencia con decaimiento exponencial (ver "Tendencias por categoría")
+    __tablename__ = 'tendencia_empresa'
+
+    empresa_id = db.Column(db.Integer, db.ForeignKey('empresa.id'), primary_key=True)
+    puntaje = db.Column(db.Float, nullable=False, default=0.0)
+    periodo = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # base del puntaje
 
 class Favorito(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -104,12 +172,31 @@ class Favorito(db.Model):
     explorador = db.relationship('Explorador', backref='favoritos')
 
 class Visita(db.Model):
+    __table_args__ = (
+        db.Index('ix_visita_empresa_fecha', 'empresa_id', 'fecha'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    empresa_id = db.Column(db.Integer, db.ForeignKey('empresa.id'))
-    explorador_id = db.Column(db.Integer, db.ForeignKey('explorador.id'), nullable=True)
+    empresa_id = db.Column(db.Integer, db.ForeignKey('empresa.id', ondelete='SET NULL'))
+    explorador_id = db.Column(db.Integer, db.ForeignKey('explorador.id', ondelete='SET NULL'), nullable=True)
     fecha = db.Column(db.DateTime, default=datetime.utcnow)
     tipo = db.Column(db.String(50), default='clic')  # clic, guardado, etc.
 
+class SesionVisita(db.Model):
+    # Una fila por par entrada/salida: guarda el tiempo de permanencia del explorador
+    __tablename__ = 'sesion_visita'
+    __table_args__ = (
+        db.Index('ix_sesion_visita_explorador_inicio', 'explorador_id', 'inicio'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    explorador_id = db.Column(db.Integer, db.ForeignKey('explorador.id', ondelete='CASCADE'), nullable=False)
+    empresa_id = db.Column(db.Integer, db.ForeignKey('empresa.id', ondelete='CASCADE'), nullable=False)
+    inicio = db.Column(db.DateTime, nullable=False)
+    segundos = db.Column(db.Integer, nullable=False, default=0)
+
+    empresa = db.relationship('Empresa', back_populates='sesiones_visita')
+
 class LogAccion(db.Model):
     __tablename__ = 'log_accion'
 
@@ -126,6 +213,490 @@ class LogAccion(db.Model):
     def __repr__(self):
         return f"<LogAccion {self.id} - {self.accion} - {self.tipo_entidad}>"
 
+class Trabajo(db.Model):
+    # Cola de trabajos en segundo plano (ver "Trabajos en segundo plano")
+    __tablename__ = 'trabajo'
+    __table_args__ = (
+        db.Index('ix_trabajo_estado_programado', 'estado', 'programado_para'),
+        # Una sola fila por trabajo periódico, aunque varios workers arranquen a la vez
+        db.Index('ux_trabajo_periodico', 'nombre', unique=True,
+                 postgresql_where=db.text('periodico'), sqlite_where=db.text('periodico')),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    nombre = db.Column(db.String(100), nullable=False)
+    argumentos = db.Column(db.Text, nullable=False, default='{}')   # JSON con los kwargs de la tarea
+    periodico = db.Column(db.Boolean, nullable=False, default=False)
+    estado = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente, en_curso, ok, fallido
+    programado_para = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    intentos = db.Column(db.Integer, nullable=False, default=0)
+    bloqueado_por = db.Column(db.String(100))
+    bloqueado_hasta = db.Column(db.DateTime)
+    ultimo_error = db.Column(db.Text)
+    creado = db.Column(db.DateTime, default=datetime.utcnow)
+    terminado = db.Column(db.DateTime)
+
+class EjecucionTrabajo(db.Model):
+    __tablename__ = 'trabajo_ejecucion'
+    __table_args__ = (
+        db.Index('ix_trabajo_ejecucion_nombre_inicio', 'nombre', 'inicio'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    trabajo_id = db.Column(db.Integer, db.ForeignKey('trabajo.id', ondelete='SET NULL'))
+    nombre = db.Column(db.String(100), nullable=False)
+    trabajador = db.Column(db.String(100))
+    inicio = db.Column(db.DateTime, nullable=False)
+    duracion_ms = db.Column(db.Float, nullable=False)
+    ok = db.Column(db.Boolean, nullable=False)
+    error = db.Column(db.Text)
+
+class AgregadoPrecalculado(db.Model):
+    # Resultados (JSON) que los trabajos periódicos dejan listos para las rutas
+    __tablename__ = 'agregado_precalculado'
+
+    clave = db.Column(db.String(100), primary_key=True)
+    datos = db.Column(db.Text, nullable=False)
+    calculado = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+# Índices para recorrer por cursor las tablas del panel de administración (TABLAS_ADMIN):
+# la misma expresión de orden que usa la consulta, seguida del id como desempate
+def orden_texto(columna):
+    # Literal y no parámetro: el motor solo usa el índice si la expresión es idéntica
+    return func.coalesce(columna, text("''"))
+
+for _columna in (Empresa.nombre_emprendimiento, Empresa.nit, Empresa.zona, Empresa.plan, Empresa.clasificacion,
+                 Explorador.primer_nombre, Explorador.primer_apellido, Explorador.telefono, Explorador.preferencias,
+                 Emprendedor.primer_nombre, Emprendedor.primer_apellido, LogAccion.accion):
+    db.Index(f'ix_{_columna.table.name}_orden_{_columna.name}', orden_texto(_columna), _columna.table.c.id)
+db.Index('ix_log_accion_fecha_id', LogAccion.fecha, LogAccion.id)
+
+# -------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Deduplicación de clics y límite de frecuencia (registrar_visita / toggle_favorito)
+
+# (ventana de duplicados en s, capacidad de la cubeta, tokens recuperados por segundo)
+LIMITE_VISITAS = (10, 5, 1 / 60)
+LIMITE_FAVORITOS = (1, 6, 1 / 10)
+
+class LimitadorMemoria:
+    """Ventana deslizante + token bucket en memoria del proceso (un worker).
+
+    Cada clave guarda cuándo deja de importar (fin de su ventana, o cuando la cubeta
+    estaría llena otra vez) y los diccionarios se mantienen en orden de última escritura,
+    así que podar es sacar del frente mientras haya claves vencidas: O(1) amortizado.
+    """
+
+    MAX_CLAVES = 50000
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._vistos = OrderedDict()    # clave -> vence
+        self._cubetas = OrderedDict()   # clave -> (tokens, ultimo, vence)
+        self._suprimidos = Counter()
+
+    def _podar(self, claves, ahora, vence):
+        while claves and vence(next(iter(claves.values()))) <= ahora:
+            claves.popitem(last=False)
+        # Con más claves vivas que el tope (p. ej. una avalancha de claves distintas) se sacrifica la más antigua
+        while len(claves) > self.MAX_CLAVES:
+            claves.popitem(last=False)
+
+    def es_duplicado(self, clave, ventana):
+        ahora = time.monotonic()
+        with self._lock:
+            vence = self._vistos.get(clave)
+            if vence is not None and ahora < vence:
+                return True
+            self._vistos[clave] = ahora + ventana
+            self._vistos.move_to_end(clave)
+            self._podar(self._vistos, ahora, lambda vence: vence)
+            return False
+
+    def consumir(self, clave, capacidad, por_segundo):
+        ahora = time.monotonic()
+        with self._lock:
+            tokens, ultimo, _ = self._cubetas.get(clave, (capacidad, ahora, None))
+            tokens = min(capacidad, tokens + (ahora - ultimo) * por_segundo)
+            permitido = tokens >= 1
+            if permitido:
+                tokens -= 1
+            # Pasado `vence` la cubeta estaría llena de nuevo: olvidarla no cambia el resultado
+            self._cubetas[clave] = (tokens, ahora, ahora + (capacidad - tokens) / por_segundo)
+            self._cubetas.move_to_end(clave)
+            self._podar(self._cubetas, ahora, lambda cubeta: cubeta[2])
+            return permitido
+
+    def contar_suprimido(self, nombre):
+        with self._lock:
+            self._suprimidos[nombre] += 1
+
+    def estadisticas(self):
+        with self._lock:
+            return dict(self._suprimidos)
+
+class LimitadorRedis:
+    """Misma semántica que LimitadorMemoria, compartida entre workers vía Redis.
+
+    El limitador solo protege a la base de datos: si Redis falla o no responde a tiempo,
+    se cuenta el error y la operación la resuelve un LimitadorMemoria local del worker.
+    """
+
+    SCRIPT_CUBETA = """
+    local capacidad = tonumber(ARGV[1])
+    local por_segundo = tonumber(ARGV[2])
+    local ahora = tonumber(ARGV[3])
+    local cubeta = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(cubeta[1]) or capacidad
+    local ts = tonumber(cubeta[2]) or ahora
+    tokens = math.min(capacidad, tokens + math.max(0, ahora - ts) * por_segundo)
+    local permitido = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        permitido = 1
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', ahora)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacidad / por_segundo) + 1)
+    return permitido
+    """
+
+    def __init__(self, url, prefijo='limites', timeout=0.25):
+        import redis  # dependencia opcional, solo si se configura LIMITES_REDIS_URL
+        self._redis = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self._cubeta = self._redis.register_script(self.SCRIPT_CUBETA)
+        self._prefijo = prefijo
+        self._errores = redis.RedisError
+        self._respaldo = LimitadorMemoria()
+
+    def _con_respaldo(self, operacion, respaldo):
+        try:
+            return operacion()
+        except self._errores:
+            metricas.incrementar('myiana_limitador_errores_total')
+            return respaldo()
+
+    def es_duplicado(self, clave, ventana):
+        return self._con_respaldo(
+            lambda: not self._redis.set(f"{self._prefijo}:visto:{clave}", 1, nx=True, px=int(ventana * 1000)),
+            lambda: self._respaldo.es_duplicado(clave, ventana))
+
+    def consumir(self, clave, capacidad, por_segundo):
+        return self._con_respaldo(
+            lambda: bool(self._cubeta(keys=[f"{self._prefijo}:cubeta:{clave}"], args=[capacidad, por_segundo, time.time()])),
+            lambda: self._respaldo.consumir(clave, capacidad, por_segundo))
+
+    def contar_suprimido(self, nombre):
+        self._con_respaldo(lambda: self._redis.hincrby(f"{self._prefijo}:suprimidos", nombre, 1),
+                           lambda: self._respaldo.contar_suprimido(nombre))
+
+    def estadisticas(self):
+        return self._con_respaldo(
+            lambda: {k.decode(): int(v) for k, v in self._redis.hgetall(f"{self._prefijo}:suprimidos").items()},
+            self._respaldo.estadisticas)
+
+def crear_limitador():
+    url = os.getenv('LIMITES_REDIS_URL')
+    return LimitadorRedis(url, timeout=float(os.getenv('LIMITES_REDIS_TIMEOUT', 0.25))) if url else LimitadorMemoria()
+
+limitador = crear_limitador()
+
+def filtrar_evento(tipo, user_id, empresa_id, limites):
+    """Devuelve 'ok', 'duplicado' o 'limitado' para el evento (tipo, usuario, empresa)."""
+    ventana, capacidad, por_segundo = limites
+    clave = f"{tipo}:{user_id}:{empresa_id}"
+    if limitador.es_duplicado(clave, ventana):
+        limitador.contar_suprimido(f"{tipo}_duplicados")
+        metricas.incrementar('myiana_eventos_filtrados_total', (('tipo', tipo), ('resultado', 'duplicado')))
+        return 'duplicado'
+    if not limitador.consumir(clave, capacidad, por_segundo):
+        limitador.contar_suprimido(f"{tipo}_limitados")
+        metricas.incrementar('myiana_eventos_filtrados_total', (('tipo', tipo), ('resultado', 'limitado')))
+        return 'limitado'
+    return 'ok'
+
+# -------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Métricas en formato Prometheus (/metrics)
+
+# Cada proceso acumula sus métricas en memoria y cada METRICAS_VOLCADO_SEGUNDOS las vuelca a
+# <METRICAS_DIR>/<pid del maestro>/<pid>.json. /metrics suma los archivos de todos los workers,
+# incluidos los que ya murieron, para que los contadores no retrocedan al reciclar un worker.
+# Agrupar por el pid del maestro de gunicorn deja fuera los archivos de despliegues anteriores.
+# Los pids se leen en cada proceso después del fork (gunicorn --preload, uWSGI), no al importar.
+METRICAS_DIR = os.getenv('METRICAS_DIR', os.path.join(tempfile.gettempdir(), 'myiana-metricas'))
+METRICAS_VOLCADO_SEGUNDOS = 1.0
+METRICAS_TOKEN = os.getenv('METRICAS_TOKEN')
+CUBETAS_SEGUNDOS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+DESCRIPCION_METRICAS = {
+    'myiana_http_request_duration_seconds': ('histogram', 'Duración de las peticiones por endpoint.'),
+    'myiana_http_requests_total': ('counter', 'Peticiones por endpoint, método y código de estado.'),
+    'myiana_db_pool_checkout_seconds': ('histogram', 'Tiempo que cada conexión permanece fuera del pool.'),
+    'myiana_eventos_total': ('counter', 'Visitas, favoritos y registros de auditoría escritos.'),
+    'myiana_eventos_filtrados_total': ('counter', 'Clics descartados por duplicados o límite de frecuencia.'),
+    'myiana_cache_total': ('counter', 'Aciertos y fallos de las cachés en memoria.'),
+    'myiana_limitador_errores_total': ('counter', 'Operaciones del limitador que fallaron en Redis y resolvió el respaldo local.'),
+}
+
+_peticion_en_curso = contextvars.ContextVar('peticion_en_curso')
+
+def _escapar_etiqueta(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class RegistroMetricas:
+    """Contadores e histogramas de este proceso, volcados a disco para sumarlos entre workers."""
+
+    def __init__(self, base, cubetas=CUBETAS_SEGUNDOS):
+        self.base = base
+        self.cubetas = cubetas
+        self._reiniciar()
+
+    def _reiniciar(self):
+        """Estado vacío para este proceso. Tras un fork se descarta lo heredado del padre
+        (lo volcará él mismo si atiende peticiones) y el lock, que pudo quedar tomado."""
+        self._lock = threading.Lock()
+        self._contadores = defaultdict(float)   # (nombre, etiquetas) -> valor
+        self._histogramas = {}                  # (nombre, etiquetas) -> [cubeta_0, ..., +Inf, suma]
+        self._peticiones = {}                   # (endpoint, método) -> (conteos, {status: total})
+        self._pendientes = deque()              # peticiones aún sin agregar al histograma
+        self._volcado = time.perf_counter()
+        self._programado = False                # hay un volcado diferido en camino
+        self._temporizador = None
+        self.directorio = os.path.join(self.base, str(os.getppid()))
+        self._archivo = os.path.join(self.directorio, f'{os.getpid()}.json')
+
+    def incrementar(self, nombre, etiquetas=(), valor=1):
+        with self._lock:
+            self._contadores[nombre, etiquetas] += valor
+
+    def observar(self, nombre, etiquetas, valor):
+        clave = (nombre, etiquetas)
+        with self._lock:
+            conteos = self._histogramas.get(clave)
+            if conteos is None:
+                conteos = self._histogramas[clave] = [0] * (len(self.cubetas) + 2)
+            conteos[bisect.bisect_left(self.cubetas, valor)] += 1
+            conteos[-1] += valor
+
+    def envolver(self, wsgi_app):
+        """Middleware WSGI que mide cada petición.
+
+        No usa before/after_request: cada acceso a los proxies de Flask (request, g) cuesta
+        por sí solo alrededor de un microsegundo. El camino caliente solo encola la medición
+        (deque.append es atómico, sin lock); el histograma se arma al volcar.
+        """
+        reloj, contexto = time.perf_counter, _peticion_en_curso
+
+        def medir(environ, start_response):
+            # endpoint y código de estado; los completan anotar_endpoint y anotar_estado.
+            # No hace falta reset: la siguiente petición del mismo hilo lo reemplaza.
+            estado = ['sin_ruta', 500]
+            contexto.set(estado)
+            inicio = reloj()
+            try:
+                return wsgi_app(environ, start_response)
+            finally:
+                ahora = reloj()
+                self._pendientes.append((estado[0], environ['REQUEST_METHOD'], estado[1], ahora - inicio))
+                if ahora - self._volcado >= METRICAS_VOLCADO_SEGUNDOS:
+                    self.volcar()
+                elif not self._programado:
+                    self._programar_volcado()
+
+        return medir
+
+    def _programar_volcado(self):
+        # Si el worker queda inactivo, lo último que midió se escribe igual al cumplirse el intervalo
+        self._programado = True
+        self._temporizador = threading.Timer(METRICAS_VOLCADO_SEGUNDOS, self.volcar)
+        self._temporizador.daemon = True
+        self._temporizador.start()
+
+    def volcar_si_pendiente(self):
+        if self._programado:
+            self.volcar()
+
+    def _agregar_pendientes(self):
+        cubetas, pendientes = self.cubetas, self._pendientes
+        while True:
+            try:
+                endpoint, metodo, status, duracion = pendientes.popleft()
+            except IndexError:
+                return
+            entrada = self._peticiones.get((endpoint, metodo))
+            if entrada is None:
+                entrada = self._peticiones[endpoint, metodo] = ([0] * (len(cubetas) + 2), defaultdict(int))
+            conteos, estados = entrada
+            conteos[bisect.bisect_left(cubetas, duracion)] += 1
+            conteos[-1] += duracion
+            estados[status] += 1
+
+    def volcar(self):
+        with self._lock:
+            self._volcado = time.perf_counter()
+            self._programado = False
+            self._agregar_pendientes()
+            contadores = [[n, list(e), v] for (n, e), v in self._contadores.items()]
+            histogramas = [[n, list(e), list(c)] for (n, e), c in self._histogramas.items()]
+            for (endpoint, metodo), (conteos, estados) in self._peticiones.items():
+                etiquetas = [['endpoint', endpoint], ['method', metodo]]
+                histogramas.append(['myiana_http_request_duration_seconds', etiquetas, list(conteos)])
+                contadores += [['myiana_http_requests_total', etiquetas + [['status', status]], total]
+                               for status, total in estados.items()]
+        os.makedirs(self.directorio, exist_ok=True)
+        temporal = f'{self._archivo}.{threading.get_ident()}.tmp'
+        with open(temporal, 'w') as f:
+            json.dump({'contadores': contadores, 'histogramas': histogramas}, f)
+        os.replace(temporal, self._archivo)
+
+    def _sumar_procesos(self):
+        contadores, histogramas = defaultdict(float), {}
+        for nombre_archivo in os.listdir(self.directorio):
+            if not nombre_archivo.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directorio, nombre_archivo)) as f:
+                    datos = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for nombre, etiquetas, valor in datos['contadores']:
+                contadores[nombre, tuple(map(tuple, etiquetas))] += valor
+            for nombre, etiquetas, conteos in datos['histogramas']:
+                clave = (nombre, tuple(map(tuple, etiquetas)))
+                acumulado = histogramas.setdefault(clave, [0] * len(conteos))
+                for i, c in enumerate(conteos):
+                    acumulado[i] += c
+        return contadores, histogramas
+
+    def exponer(self):
+        """Texto en formato de exposición de Prometheus (0.0.4) con la suma de todos los workers."""
+        self.volcar()
+        contadores, histogramas = self._sumar_procesos()
+
+        def etiquetar(etiquetas, extra=()):
+            pares = [f'{k}="{_escapar_etiqueta(v)}"' for k, v in (*etiquetas, *extra)]
+            return '{' + ','.join(pares) + '}' if pares else ''
+
+        lineas = []
+        for nombre, (tipo, ayuda) in DESCRIPCION_METRICAS.items():
+            lineas += [f'# HELP {nombre} {ayuda}', f'# TYPE {nombre} {tipo}']
+            if tipo == 'counter':
+                for (n, etiquetas), valor in sorted(contadores.items(), key=repr):
+                    if n == nombre:
+                        lineas.append(f'{nombre}{etiquetar(etiquetas)} {valor:.17g}')
+                continue
+            for (n, etiquetas), conteos in sorted(histogramas.items(), key=repr):
+                if n != nombre:
+                    continue
+                acumulado = 0
+                for limite, c in zip((*self.cubetas, '+Inf'), conteos[:-1]):
+                    acumulado += c
+                    lineas.append(f'{nombre}_bucket{etiquetar(etiquetas, [("le", limite)])} {acumulado}')
+                lineas.append(f'{nombre}_sum{etiquetar(etiquetas)} {conteos[-1]:.6f}')
+                lineas.append(f'{nombre}_count{etiquetar(etiquetas)} {acumulado}')
+        return '\n'.join(lineas) + '\n'
+
+
+metricas = RegistroMetricas(METRICAS_DIR)
+os.register_at_fork(after_in_child=metricas._reiniciar)
+atexit.register(metricas.volcar_si_pendiente)
+
+@app.url_value_preprocessor
+def anotar_endpoint(endpoint, values):
+    estado = _peticion_en_curso.get(None)
+    if estado is not None and endpoint:   # endpoint es None si la URL no existe (404)
+        estado[0] = endpoint
+
+@app.after_request
+def anotar_estado(response):
+    estado = _peticion_en_curso.get(None)
+    if estado is not None:
+        estado[1] = response.status_code
+    return response
+
+app.wsgi_app = metricas.envolver(app.wsgi_app)
+
+# Tiempo que cada conexión pasa fuera del pool (entre checkout y checkin)
+@event.listens_for(Pool, 'checkout')
+def _pool_checkout(dbapi_conn, registro, proxy):
+    registro.info['checkout_en'] = time.perf_counter()
+
+@event.listens_for(Pool, 'checkin')
+def _pool_checkin(dbapi_conn, registro):
+    inicio = registro.info.pop('checkout_en', None)
+    if inicio is not None:
+        metricas.observar('myiana_db_pool_checkout_seconds', (), time.perf_counter() - inicio)
+
+# Eventos de negocio, contados al insertarse/borrarse sin importar qué ruta los escriba
+def _contar_evento(tipo):
+    etiquetas = (('tipo', tipo),)
+    return lambda mapper, conexion, objeto: metricas.incrementar('myiana_eventos_total', etiquetas)
+
+event.listen(Visita, 'after_insert', _contar_evento('visita'))
+event.listen(Favorito, 'after_insert', _contar_evento('favorito_agregado'))
+event.listen(Favorito, 'after_delete', _contar_evento('favorito_eliminado'))
+event.listen(LogAccion, 'after_insert', _contar_evento('auditoria'))
+
+@app.route('/metrics')
+def exponer_metricas():
+    if METRICAS_TOKEN and request.headers.get('Authorization') != f'Bearer {METRICAS_TOKEN}':
+        return jsonify({'error': 'No autorizado'}), 403
+    return Response(metricas.exponer(), mimetype='text/plain; version=0.0.4')
+
+@app.cli.command('benchmark-metricas')
+@click.option('--peticiones', default=200000)
+@click.option('--rondas', default=5, help='Repeticiones de la medición del middleware.')
+def benchmark_metricas(peticiones, rondas):
+    """Costo por petición del middleware de métricas y costo de cada volcado."""
+    registro = RegistroMetricas(tempfile.mkdtemp(prefix='metricas-bench-'))
+    endpoints = [f'ruta_{i}' for i in range(20)]
+
+    respuesta = Response()
+
+    def aplicacion_vacia(environ, start_response, hooks=False):
+        if hooks:  # lo que hace Flask al enrutar y al terminar la petición
+            anotar_endpoint('ruta_0', {})
+            anotar_estado(respuesta)
+        start_response('200 OK', [])
+        return [b'']
+
+    def responder(status, headers, exc_info=None):
+        pass
+
+    environ = {'REQUEST_METHOD': 'GET'}
+    medida = registro.envolver(lambda environ, start_response: aplicacion_vacia(environ, start_response, True))
+    sin_medir = lambda environ, start_response: aplicacion_vacia(environ, start_response)
+
+    # Rondas alternadas: el ruido de la máquina afecta por igual a ambas variantes
+    costos = []
+    for _ in range(rondas):
+        tiempos = []
+        for app_wsgi in (sin_medir, medida):
+            t0 = time.perf_counter()
+            for _ in range(peticiones):
+                app_wsgi(environ, responder)
+            tiempos.append((time.perf_counter() - t0) / peticiones)
+        costos.append(tiempos[1] - tiempos[0])
+    costos.sort()
+
+    registro.volcar()
+    t0 = time.perf_counter()
+    for _ in range(100):
+        registro.volcar()
+    volcado = (time.perf_counter() - t0) / 100
+
+    for i in range(peticiones):
+        registro._pendientes.append((endpoints[i % 20], 'GET', 200, 0.01))
+    t0 = time.perf_counter()
+    registro.volcar()
+    agregado = (time.perf_counter() - t0 - volcado) / peticiones
+
+    click.echo(f"Middleware por petición ({rondas} rondas): mediana {costos[len(costos) // 2] * 1e9:.0f} ns, "
+               f"mín {costos[0] * 1e9:.0f} ns, máx {costos[-1] * 1e9:.0f} ns")
+    click.echo(f"Volcado a disco: {volcado * 1e6:.0f} µs (como mucho uno por segundo y proceso)")
+    click.echo(f"Agregado al volcar: {agregado * 1e9:.0f} ns por petición encolada")
+    if registro._temporizador:
+        registro._temporizador.cancel()
+    shutil.rmtree(registro.base, ignore_errors=True)
+
 # Rutas
 @app.route('/BotonLog')
 def index():
@@ -182,9 +753,9 @@ def register():
                 primer_apellido=request.form.get('primer_apellido', '').strip(),
                 segundo_apellido=request.form.get('segundo_apellido', '').strip(),
                 fecha_nacimiento=fecha_nacimiento,
-                telefono=request.form.get('telefono', '').strip(),
-                preferencias=request.form.get('preferencias', '').strip()
+                telefono=request.form.get('telefono', '').strip()
             )
+            asignar_preferencias(nuevo_explorador, parsear_preferencias(request.form.getlist('preferencias')))
             db.session.add(nuevo_explorador)
 
         elif role == 'Emprendedor':
@@ -248,6 +819,15 @@ def login():
 
     return render_template('Base/login.html')
 
+def obtener_empresa_emprendedor(user_id):
+    """(emprendedor, empresa) del usuario en una sola consulta; empresa puede ser None."""
+    fila = db.session.query(Emprendedor, Empresa)\
+        .outerjoin(Empresa, Empresa.emprendedor_id == Emprendedor.id)\
+        .filter(Emprendedor.user_id == user_id)\
+        .order_by(Empresa.id)\
+        .first()
+    return tuple(fila) if fila else (None, None)
+
 @app.route('/emprendedor/dashboard')
 def emprendedor_dashboard():
     user_id = session.get('user_id')
@@ -255,39 +835,44 @@ def emprendedor_dashboard():
         flash('Por favor inicia sesión como emprendedor.', 'warning')
         return redirect(url_for('login'))
 
-    # Buscar el emprendedor asociado al usuario actual
-    emprendedor = Emprendedor.query.filter_by(user_id=user_id).first()
+    # Buscar el emprendedor y su empresa asociados al usuario actual
+    emprendedor, empresa = obtener_empresa_emprendedor(user_id)
 
     if not emprendedor:
         flash('No se encontró información de emprendedor.', 'danger')
         return redirect(url_for('login'))
 
-    # Verificar si ya tiene una empresa asociada
-    empresa = Empresa.query.filter_by(emprendedor_id=emprendedor.id).first()
-
     # Si no existe, lo mandamos al formulario para registrar su empresa
     if not empresa:
         flash('Por favor completa la información de tu empresa antes de continuar.', 'info')
         return redirect(url_for('registrar_empresa'))
 
-    acciones = db.session.query(LogAccion.accion, db.func.count(LogAccion.id))\
-        .filter_by(user_id=user_id)\
-        .group_by(LogAccion.accion)\
-        .all()
-
-    acciones_labels = [a[0] for a in acciones] or ["Sin registros"]
-    acciones_values = [a[1] for a in acciones] or [0]
-    favoritos_count = Favorito.query.filter_by(empresa_id=empresa.id).count()
+    # Todos los datos del panel van embebidos en la página: no hacen falta más peticiones
+    dashboard = obtener_dashboard_emprendedor(empresa, user_id)
 
     # Si ya tiene empresa, renderizamos el dashboard normal
     return render_template(
         'Emprededores/dashboard_emprededor.html', 
         emprendedor=emprendedor, empresa=empresa,
-        acciones_labels=acciones_labels,
-        acciones_values=acciones_values,
-        favoritos_count=favoritos_count
+        acciones_labels=dashboard['acciones']['labels'],
+        acciones_values=dashboard['acciones']['values'],
+        favoritos_count=dashboard['favoritos_count'],
+        visitas_count=dashboard['visitas_total'],
+        dashboard=dashboard
         )
 
+@app.route('/api/dashboard_emprendedor')
+def api_dashboard_emprendedor():
+    user_id = session.get('user_id')
+    if not user_id or session.get('role') != 'Emprendedor':
+        return jsonify({'error': 'Debes iniciar sesión como emprendedor.'}), 403
+
+    _, empresa = obtener_empresa_emprendedor(user_id)
+    if not empresa:
+        return jsonify({'error': 'Empresa no encontrada.'}), 404
+
+    return jsonify(obtener_dashboard_emprendedor(empresa, user_id))
+
 @app.route('/registrar_visita/<int:empresa_id>', methods=['POST'])
 def registrar_visita(empresa_id):
     # Verificar si hay sesión activa
@@ -295,6 +880,14 @@ def registrar_visita(empresa_id):
         return jsonify({'success': False, 'message': 'Debes iniciar sesión como explorador.'}), 403
 
     user_id = session['user_id']
+
+    # Los clics repetidos se agrupan antes de tocar la base de datos
+    resultado = filtrar_evento('visita', user_id, empresa_id, LIMITE_VISITAS)
+    if resultado == 'duplicado':
+        return jsonify({'success': True, 'duplicada': True})
+    if resultado == 'limitado':
+        return jsonify({'success': False, 'message': 'Demasiadas visitas seguidas.'}), 429
+
     explorador = Explorador.query.filter_by(user_id=user_id).first()
 
     if not explorador:
@@ -303,80 +896,261 @@ def registrar_visita(empresa_id):
     # Registrar visita
     nueva_visita = Visita(
         empresa_id=empresa_id,
+        explorador_id=explorador.id,
         fecha=datetime.utcnow(),
         tipo='clic'
     )
     db.session.add(nueva_visita)
+    sumar_tendencia(empresa_id, PESO_VISITA, nueva_visita.fecha)
     db.session.commit()
+    notificar_empresa(empresa_id, 'visitas', {'delta': 1})
 
     return jsonify({'success': True})
 
-@app.route('/api/visitas/<int:empresa_id>')
-def visitas_por_dia(empresa_id):
-    from datetime import datetime
-    dias_semana = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
-    visitas = [0] * 7  # Inicializa con 0 para los 7 días
+# Límites para los lotes de eventos enviados con navigator.sendBeacon
+MAX_EVENTOS_LOTE = 200
+MAX_SEGUNDOS_SESION = 4 * 60 * 60
+# `t` lo pone el reloj del cliente: se aceptan lotes encolados hasta un día y un adelanto pequeño
+MAX_ANTIGUEDAD_EVENTO = timedelta(days=1)
+MAX_ADELANTO_EVENTO = timedelta(minutes=5)
+
+def emparejar_eventos_visita(eventos, explorador_id, ahora=None):
+    """Convierte eventos entrada/salida en filas de SesionVisita (una por par)."""
+    ahora = ahora or datetime.utcnow()
+    desde, hasta = ahora - MAX_ANTIGUEDAD_EVENTO, ahora + MAX_ADELANTO_EVENTO
+    abiertas = {}
+    filas = []
+    for ev in eventos[:MAX_EVENTOS_LOTE]:
+        try:
+            empresa_id = _entero_sql(int(ev['empresa_id']))
+            instante = datetime.utcfromtimestamp(float(ev['t']) / 1000)
+        except (KeyError, TypeError, ValueError, OverflowError, OSError):
+            continue
+        if not desde <= instante <= hasta:
+            continue
+
+        if ev.get('tipo') == 'entrada':
+            abiertas[empresa_id] = instante
+        elif ev.get('tipo') == 'salida' and empresa_id in abiertas:
+            inicio = abiertas.pop(empresa_id)
+            segundos = int((instante - inicio).total_seconds())
+            if 0 <= segundos <= MAX_SEGUNDOS_SESION:
+                filas.append({
+                    'explorador_id': explorador_id,
+                    'empresa_id': empresa_id,
+                    'inicio': inicio,
+                    'segundos': segundos
+                })
+    # Las entradas sin salida se descartan: el cliente cierra las abiertas al enviar el lote
+    return filas
+
+@app.route('/api/visitas/lote', methods=['POST'])
+def registrar_visitas_lote():
+    if 'user_id' not in session or session.get('role') != 'Explorador':
+        return jsonify({'success': False, 'message': 'Debes iniciar sesión como explorador.'}), 403
+
+    # sendBeacon no siempre envía Content-Type: application/json
+    datos = request.get_json(force=True, silent=True)
+    eventos = datos.get('eventos') if isinstance(datos, dict) else None
+    if not isinstance(eventos, list):
+        return jsonify({'success': False, 'message': 'Formato de lote inválido.'}), 400
+
+    explorador = Explorador.query.filter_by(user_id=session['user_id']).first()
+    if not explorador:
+        return jsonify({'success': False, 'message': 'Explorador no encontrado.'}), 404
+
+    filas = emparejar_eventos_visita(eventos, explorador.id)
+    if filas:
+        # Un solo INSERT (executemany) y un solo commit por lote
+        empresas_validas = {
+            e_id for (e_id,) in db.session.query(Empresa.id)
+            .filter(Empresa.id.in_({f['empresa_id'] for f in filas}))
+        }
+        filas = [f for f in filas if f['empresa_id'] in empresas_validas]
+        if filas:
+            db.session.execute(db.insert(SesionVisita), filas)
+            db.session.commit()
+
+    return jsonify({'success': True, 'guardadas': len(filas)})
+
+@app.route('/api/historial_visitas')
+def historial_visitas():
+    if 'user_id' not in session or session.get('role') != 'Explorador':
+        return jsonify({'success': False, 'message': 'Debes iniciar sesión como explorador.'}), 403
+
+    explorador = Explorador.query.filter_by(user_id=session['user_id']).first()
+    if not explorador:
+        return jsonify({'success': False, 'message': 'Explorador no encontrado.'}), 404
+
+    pagina = request.args.get('pagina', 1, type=int)
+    por_pagina = min(request.args.get('por_pagina', 10, type=int), 50)
 
-    registros = Visita.query.filter_by(empresa_id=empresa_id).all()
+    consulta = db.session.query(
+        SesionVisita.inicio, SesionVisita.segundos,
+        Empresa.id, Empresa.nombre_emprendimiento, Empresa.clasificacion
+    ).join(Empresa, Empresa.id == SesionVisita.empresa_id)\
+        .filter(SesionVisita.explorador_id == explorador.id)\
+        .order_by(SesionVisita.inicio.desc())
 
-    for v in registros:
-        dia = v.fecha.weekday()  # Lunes=0, Domingo=6
-        visitas[dia] += 1
+    resultado = consulta.paginate(page=pagina, per_page=por_pagina, error_out=False)
+
+    return jsonify({
+        'pagina': resultado.page,
+        'paginas': resultado.pages,
+        'total': resultado.total,
+        'items': [{
+            'empresa_id': empresa_id,
+            'empresa': nombre,
+            'clasificacion': clasificacion,
+            'fecha': inicio.strftime("%Y-%m-%d %H:%M"),
+            'segundos': segundos
+        } for inicio, segundos, empresa_id, nombre, clasificacion in resultado.items]
+    })
 
+DIAS_SEMANA = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
+SEMANAS_HISTORIAL = 10
+
+def contar_visitas_por_dia(empresa_id, desde=None):
+    """Visitas reales agrupadas por día de la semana (Lunes=0) con un solo GROUP BY."""
+    dow = db.extract('dow', Visita.fecha)  # 0 = Domingo tanto en SQLite como en PostgreSQL
+    consulta = db.session.query(dow, func.count(Visita.id)).filter(Visita.empresa_id == empresa_id)
+    if desde is not None:
+        consulta = consulta.filter(Visita.fecha >= desde)
+    conteo = [0] * 7
+    for dia, total in consulta.group_by(dow):
+        if dia is not None:
+            conteo[(int(dia) + 6) % 7] += total
+    return conteo
+
+def clave_semana(dia):
+    anio, semana, _ = dia.isocalendar()
+    return f"{anio}-{semana:02d}"
+
+def ventana_semanas(hoy):
+    """Claves ISO de las últimas SEMANAS_HISTORIAL semanas (de la más antigua a la más reciente)
+    y el lunes a medianoche en que empieza la más antigua."""
+    claves = [clave_semana(hoy - timedelta(weeks=i)) for i in range(SEMANAS_HISTORIAL)][::-1]
+    inicio = (hoy - timedelta(weeks=SEMANAS_HISTORIAL - 1, days=hoy.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+    return claves, inicio
+
+def contar_visitas_semanas(empresa_id, hoy=None, desde=None):
+    """Para cada día de la semana, visitas de las últimas SEMANAS_HISTORIAL semanas
+    (de la más antigua a la más reciente), a partir de un único GROUP BY por fecha."""
+    claves, inicio = ventana_semanas(hoy or datetime.utcnow())
+    posicion = {clave: i for i, clave in enumerate(claves)}
+
+    serie = [[0] * SEMANAS_HISTORIAL for _ in range(7)]
+    dia_fecha = func.date(Visita.fecha)
+    for dia, total in db.session.query(dia_fecha, func.count(Visita.id))\
+            .filter(Visita.empresa_id == empresa_id, Visita.fecha >= max(inicio, desde or inicio)).group_by(dia_fecha):
+        if isinstance(dia, str):  # SQLite devuelve la fecha como texto
+            dia = date.fromisoformat(dia)
+        i = posicion.get(clave_semana(dia))
+        if i is not None:
+            serie[dia.weekday()][i] += total
+    return serie
+
+def visitas_empresa(empresa_id):
+    """(conteo por día de la semana, serie por semanas) de la empresa.
+
+    Parte de lo que dejó precalculado el trabajo 'visitas-empresas' y solo consulta las visitas
+    posteriores; si el trabajo no ha corrido hace rato, lo calcula todo aquí mismo.
+    """
+    guardado = leer_agregado(f'visitas:{empresa_id}', 3 * INTERVALO_VISITAS_EMPRESAS)
+    if guardado is None:
+        return contar_visitas_por_dia(empresa_id), contar_visitas_semanas(empresa_id)
+
+    hasta = datetime.fromisoformat(guardado['hasta'])
+    conteo = [a + b for a, b in zip(guardado['dias'], contar_visitas_por_dia(empresa_id, desde=hasta))]
+    claves, _ = ventana_semanas(datetime.utcnow())
+    recientes = contar_visitas_semanas(empresa_id, desde=hasta)
+    vacia = [0] * 7
+    serie = [[guardado['semanas'].get(clave, vacia)[d] + recientes[d][i] for i, clave in enumerate(claves)]
+             for d in range(7)]
+    return conteo, serie
+
+def respaldo_visitas_semana(conteo):
     # Si no hay suficientes datos, generar aleatorios de respaldo
-    if sum(visitas) < 5:
-        import random
-        visitas = [random.randint(5, 20) for _ in range(7)]
+    if sum(conteo) < 5:
+        return [random.randint(5, 20) for _ in range(7)]
+    return conteo
 
+def respaldo_visitas_dia(serie):
+    # Si no hay datos en una semana, generamos aleatorios
+    return [c or random.randint(3, 15) for c in serie]
+
+@app.route('/api/visitas/<int:empresa_id>')
+def visitas_por_dia(empresa_id):
     return jsonify({
-        'labels': dias_semana,
-        'values': visitas
+        'labels': DIAS_SEMANA,
+        'values': respaldo_visitas_semana(visitas_empresa(empresa_id)[0])
     })
 
 @app.route('/api/visitas_dia/<int:empresa_id>/<string:dia>')
 def visitas_por_dia_semana(empresa_id, dia):
-    from datetime import datetime, timedelta
-    import random
-
-    dias_semana = ['Lunes', 'Martes', 'Miércoles', 'Jueves', 'Viernes', 'Sábado', 'Domingo']
-    if dia not in dias_semana:
+    if dia not in DIAS_SEMANA:
         return jsonify({'error': 'Día no válido'}), 400
 
-    dia_index = dias_semana.index(dia)
-
-    # Generar las últimas 10 semanas
-    hoy = datetime.utcnow()
-    semanas_labels = []
-    visitas_semanales = []
-
-    for i in range(10):
-        semana_inicio = hoy - timedelta(weeks=i)
-        semana_label = f"Semana {10 - i}"
-        semanas_labels.append(semana_label)
-
-        # Filtrar visitas reales por esa semana y día
-        semana_visitas = (
-            Visita.query.filter(
-                Visita.empresa_id == empresa_id,
-                db.extract('week', Visita.fecha) == semana_inicio.isocalendar()[1],
-                db.extract('year', Visita.fecha) == semana_inicio.year
-            ).all()
-        )
+    serie = visitas_empresa(empresa_id)[1][DIAS_SEMANA.index(dia)]
+    return jsonify({
+        'labels': [f"Semana {i + 1}" for i in range(SEMANAS_HISTORIAL)],  # de la más antigua a la más reciente
+        'values': respaldo_visitas_dia(serie)
+    })
 
-        # Contar las que correspondan al día elegido
-        count = sum(1 for v in semana_visitas if v.fecha.weekday() == dia_index)
-        # Si no hay suficientes datos, generamos aleatorios
-        if count == 0:
-            count = random.randint(3, 15)
+# --- Panel del emprendedor en una sola respuesta, cacheado por empresa ---
+DASHBOARD_CACHE_SEGUNDOS = 30
+_cache_dashboard = {}
 
-        visitas_semanales.append(count)
+def invalidar_dashboard(empresa_id):
+    _cache_dashboard.pop(empresa_id, None)
 
-    return jsonify({
-        'labels': semanas_labels[::-1],  # mostrar de la más antigua a la más reciente
-        'values': visitas_semanales[::-1]
-    })
+def construir_dashboard_emprendedor(empresa, user_id):
+    """Calcula el panel completo con un número fijo de consultas (5 o 6, sin contar la de la empresa)."""
+    favoritos_count = db.session.query(func.count(Favorito.id)).filter(Favorito.empresa_id == empresa.id).scalar()
+
+    acciones = db.session.query(LogAccion.accion, func.count(LogAccion.id))\
+        .filter(LogAccion.user_id == user_id)\
+        .group_by(LogAccion.accion)\
+        .all()
 
+    conteo_dias, serie_semanas = visitas_empresa(empresa.id)
+
+    return {
+        'empresa': {
+            'id': empresa.id,
+            'nombre': empresa.nombre_emprendimiento,
+            'nit': empresa.nit,
+            'clasificacion': empresa.clasificacion,
+            'plan': empresa.plan,
+            'zona': empresa.zona,
+            'ubicacion': empresa.ubicacion
+        },
+        'favoritos_count': favoritos_count,
+        'acciones': {
+            'labels': [a[0] for a in acciones] or ["Sin registros"],
+            'values': [a[1] for a in acciones] or [0]
+        },
+        'visitas_total': sum(conteo_dias),
+        'visitas_semana': {
+            'labels': DIAS_SEMANA,
+            'values': respaldo_visitas_semana(conteo_dias)
+        },
+        'visitas_por_dia': {
+            'labels': [f"Semana {i + 1}" for i in range(SEMANAS_HISTORIAL)],
+            'values': {dia: respaldo_visitas_dia(serie) for dia, serie in zip(DIAS_SEMANA, serie_semanas)}
+        },
+        'auditoria_favoritos': consultar_auditoria_favoritos(empresa)
+    }
 
+def obtener_dashboard_emprendedor(empresa, user_id):
+    guardado = _cache_dashboard.get(empresa.id)
+    if guardado and guardado[0] > time.monotonic():
+        metricas.incrementar('myiana_cache_total', (('cache', 'dashboard'), ('resultado', 'acierto')))
+        return guardado[1]
+    metricas.incrementar('myiana_cache_total', (('cache', 'dashboard'), ('resultado', 'fallo')))
+    datos = construir_dashboard_emprendedor(empresa, user_id)
+    _cache_dashboard[empresa.id] = (time.monotonic() + DASHBOARD_CACHE_SEGUNDOS, datos)
+    return datos
 
 @app.route('/registrar_empresa', methods=['GET', 'POST'])
 def registrar_empresa():
@@ -437,9 +1211,12 @@ def registrar_empresa():
             imagen_filename=imagen_url,
             emprendedor_id=emprendedor.id
         )
+        geocodificar_empresa(nueva_empresa)
 
         db.session.add(nueva_empresa)
         db.session.commit()
+        invalidar_indice_empresas()
+        tablero_tendencias.invalidar()
 
         log = LogAccion(
             accion="Creación de Empresa",
@@ -467,8 +1244,13 @@ def editar_empresa(id):
     empresa.plan = request.form.get('plan', empresa.plan)
     empresa.rango_precios = request.form.get('rango_precios', empresa.rango_precios)
     empresa.clasificacion = request.form.get('clasificacion', empresa.clasificacion)
+    if empresa.zona != datos_antes.get('zona'):
+        geocodificar_empresa(empresa, forzar=True)
 
     db.session.commit()
+    invalidar_indice_empresas()
+    tablero_tendencias.invalidar()
+    invalidar_dashboard(empresa.id)
 
     # Auditoría
     cambios = []
@@ -536,15 +1318,28 @@ def toggle_favorito():
     if not empresa_id:
         return jsonify({'ok': False, 'msg': 'Falta empresa_id'}), 400
 
+    resultado = filtrar_evento('favorito', session['user_id'], empresa_id, LIMITE_FAVORITOS)
+    if resultado == 'limitado':
+        return jsonify({'ok': False, 'msg': 'Demasiadas solicitudes, intenta de nuevo en unos segundos.'}), 429
+
     empresa = Empresa.query.get(empresa_id)
     if not empresa:
         return jsonify({'ok': False, 'msg': 'Empresa no encontrada'}), 404
 
     fav = Favorito.query.filter_by(explorador_id=explorador.id, empresa_id=empresa.id).first()
+    if resultado == 'duplicado':
+        # Doble clic: se responde con el estado actual sin escribir ni auditar
+        return jsonify({
+            'ok': True,
+            'action': 'added' if fav else 'removed',
+            'favoritos_count': Favorito.query.filter_by(empresa_id=empresa.id).count(),
+            'duplicado': True
+        })
     nombre_usuario = explorador.user.username if hasattr(explorador, 'user') and explorador.user else f"Explorador {explorador.id}"
     if fav:
-        # quitar favorito
+        # quitar favorito (se resta exactamente lo que sumó al guardarse)
         db.session.delete(fav)
+        sumar_tendencia(empresa.id, -PESO_FAVORITO, fav.fecha_guardado)
 
         # Registrar auditoría
         log = LogAccion(
@@ -559,8 +1354,9 @@ def toggle_favorito():
         action = 'removed'
     else:
         # crear favorito
-        fav = Favorito(explorador_id=explorador.id, empresa_id=empresa.id)
+        fav = Favorito(explorador_id=explorador.id, empresa_id=empresa.id, fecha_guardado=datetime.utcnow())
         db.session.add(fav)
+        sumar_tendencia(empresa.id, PESO_FAVORITO, fav.fecha_guardado)
         #Registrar auditoría
         log = LogAccion(
             user_id=session['user_id'],
@@ -576,11 +1372,224 @@ def toggle_favorito():
 
     # devolver nuevo conteo de favoritos
     fav_count = Favorito.query.filter_by(empresa_id=empresa.id).count()
+    notificar_empresa(empresa.id, 'favoritos', {
+        'delta': 1 if action == 'added' else -1,
+        'total': fav_count,
+        'usuario': nombre_usuario,
+        'accion': 'Agregacion Favorito' if action == 'added' else 'Eliminación Favorito',
+        'fecha': datetime.utcnow().strftime("%Y-%m-%d %H:%M")
+    })
     return jsonify({'ok': True, 'action': action, 'favoritos_count': fav_count})
 
 
+# -------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Estáticos con huella de contenido
+
+# `flask construir-estaticos` copia static/ a static/dist/ con el hash del
+# contenido en el nombre, precomprime los textos (gzip y, si está instalado,
+# brotli) y genera variantes WebP de las fotos (si está Pillow). Como el nombre
+# cambia con el contenido, /assets/ puede servirlos con caché inmutable de un año.
+DIR_ESTATICOS = os.path.join(app.root_path, 'static')
+DIR_DIST = os.path.join(DIR_ESTATICOS, 'dist')
+MANIFIESTO_ESTATICOS = os.path.join(DIR_DIST, 'manifest.json')
+EXT_COMPRIMIBLES = {'.css', '.js', '.svg', '.ico', '.json', '.txt'}
+EXT_WEBP = {'.jpg', '.jpeg'}
+CACHE_INMUTABLE = 'public, max-age=31536000, immutable'
+PATRON_URL_CSS = re.compile(r"""url\((['"]?)/static/([^'")]+)\1\)""")
+
+
+def cargar_manifiesto_estaticos():
+    try:
+        with open(MANIFIESTO_ESTATICOS, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+_manifiesto_estaticos = cargar_manifiesto_estaticos()
+
+
+def url_estatico(filename):
+    """Como url_for('static', ...) pero apunta a la versión con hash si existe."""
+    entrada = _manifiesto_estaticos.get(filename)
+    if entrada:
+        return url_for('asset_inmutable', filename=entrada['archivo'])
+    return url_for('static', filename=filename)
+
+
+def url_webp(filename):
+    """URL de la variante WebP de una imagen, o None si no se generó."""
+    entrada = _manifiesto_estaticos.get(filename)
+    if entrada and entrada.get('webp'):
+        return url_for('asset_inmutable', filename=entrada['webp'])
+    return None
+
+
+app.jinja_env.globals.update(url_estatico=url_estatico, url_webp=url_webp)
+
+
+def _nombre_con_hash(ruta, contenido, ext=None):
+    base, ext_original = os.path.splitext(ruta)
+    huella = hashlib.sha256(contenido).hexdigest()[:10]
+    return f"{base}.{huella}{ext or ext_original}"
+
+
+def _escribir_dist(ruta, contenido):
+    destino = os.path.join(DIR_DIST, ruta)
+    os.makedirs(os.path.dirname(destino), exist_ok=True)
+    with open(destino, 'wb') as f:
+        f.write(contenido)
+
+
+def construir_estaticos():
+    """Genera static/dist y su manifest.json. Devuelve el manifiesto."""
+    try:
+        import brotli  # dependencia opcional
+    except ImportError:
+        brotli = None
+    try:
+        from PIL import Image  # dependencia opcional
+    except ImportError:
+        Image = None
+
+    shutil.rmtree(DIR_DIST, ignore_errors=True)
+    rutas = []
+    for carpeta, subcarpetas, archivos in os.walk(DIR_ESTATICOS):
+        subcarpetas[:] = [s for s in subcarpetas if os.path.join(carpeta, s) != DIR_DIST]
+        for archivo in archivos:
+            rutas.append(os.path.relpath(os.path.join(carpeta, archivo), DIR_ESTATICOS).replace(os.sep, '/'))
+    # El CSS va al final para poder reescribir sus url(/static/...) con los nombres ya calculados
+    rutas.sort(key=lambda r: (r.endswith('.css'), r))
+
+    manifiesto = {}
+    for ruta in rutas:
+        with open(os.path.join(DIR_ESTATICOS, ruta), 'rb') as f:
+            contenido = f.read()
+        ext = os.path.splitext(ruta)[1].lower()
+
+        if ext == '.css':
+            def reescribir(m):
+                entrada = manifiesto.get(m.group(2))
+                if not entrada:
+                    return m.group(0)
+                return f"url({m.group(1)}/assets/{entrada['archivo']}{m.group(1)})"
+            contenido = PATRON_URL_CSS.sub(reescribir, contenido.decode('utf-8')).encode('utf-8')
+
+        entrada = {'archivo': _nombre_con_hash(ruta, contenido), 'bytes': len(contenido)}
+        _escribir_dist(entrada['archivo'], contenido)
+
+        if ext in EXT_COMPRIMIBLES:
+            comprimido = gzip.compress(contenido, compresslevel=9, mtime=0)
+            _escribir_dist(entrada['archivo'] + '.gz', comprimido)
+            entrada['gzip'] = len(comprimido)
+            if brotli:
+                comprimido = brotli.compress(contenido, quality=11)
+                _escribir_dist(entrada['archivo'] + '.br', comprimido)
+                entrada['br'] = len(comprimido)
+
+        if ext in EXT_WEBP and Image:
+            salida = io.BytesIO()
+            with Image.open(io.BytesIO(contenido)) as imagen:
+                imagen.save(salida, 'WEBP', quality=80, method=6)
+            webp = salida.getvalue()
+            if len(webp) < len(contenido):
+                entrada['webp'] = _nombre_con_hash(ruta, webp, '.webp')
+                entrada['webp_bytes'] = len(webp)
+                _escribir_dist(entrada['webp'], webp)
+
+        manifiesto[ruta] = entrada
+
+    _escribir_dist('manifest.json', json.dumps(manifiesto, indent=2, sort_keys=True).encode('utf-8'))
+    return manifiesto
+
+
+@app.route('/assets/<path:filename>')
+def asset_inmutable(filename):
+    aceptadas = request.headers.get('Accept-Encoding', '')
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    for codificacion, sufijo in (('br', '.br'), ('gzip', '.gz')):
+        if codificacion in aceptadas and os.path.isfile(os.path.join(DIR_DIST, filename + sufijo)):
+            respuesta = send_from_directory(DIR_DIST, filename + sufijo, mimetype=mimetype)
+            respuesta.headers['Content-Encoding'] = codificacion
+            break
+    else:
+        respuesta = send_from_directory(DIR_DIST, filename, mimetype=mimetype)
+    respuesta.headers['Cache-Control'] = CACHE_INMUTABLE
+    respuesta.headers['Vary'] = 'Accept-Encoding'
+    return respuesta
+
+
+@app.cli.command('construir-estaticos')
+def construir_estaticos_cmd():
+    """Genera los estáticos con hash, gzip/brotli y WebP en static/dist."""
+    global _manifiesto_estaticos
+    _manifiesto_estaticos = construir_estaticos()
+    entradas = _manifiesto_estaticos.values()
+    click.echo(f"Archivos: {len(_manifiesto_estaticos)}, "
+               f"comprimidos: {sum('gzip' in e for e in entradas)}, "
+               f"brotli: {sum('br' in e for e in entradas)}, "
+               f"webp: {sum('webp' in e for e in entradas)}")
+
+
+PATRON_PICTURE = re.compile(r'<picture>.*?</picture>', re.S)
+PATRON_RECURSO = re.compile(r'(?:src|srcset|href)="(/(?:static|assets)/[^"]+)"')
+PATRON_URL_RECURSO_CSS = re.compile(r"""url\((['"]?)(/(?:static|assets)/[^'")]+)\1\)""")
+
+
+def _bytes_vista(cliente, ruta, cache):
+    """Bytes de estáticos que descarga una vista de `ruta`, dado lo que ya está en `cache`."""
+    html = cliente.get(ruta).get_data(as_text=True)
+    # Dentro de <picture> el navegador solo descarga la primera fuente que soporta (WebP)
+    html = PATRON_PICTURE.sub(lambda m: PATRON_RECURSO.search(m.group(0)).group(0), html)
+    pendientes, vistos, total = PATRON_RECURSO.findall(html), set(), 0
+    while pendientes:
+        url = pendientes.pop()
+        if url in vistos:
+            continue
+        vistos.add(url)
+        respuesta = cliente.get(url, headers={'Accept-Encoding': 'gzip, deflate, br'})
+        cuerpo = respuesta.get_data()
+        respuesta.close()
+        if url.endswith('.css'):
+            codificacion = respuesta.headers.get('Content-Encoding')
+            texto = cuerpo
+            if codificacion == 'gzip':
+                texto = gzip.decompress(cuerpo)
+            elif codificacion == 'br':
+                import brotli
+                texto = brotli.decompress(cuerpo)
+            pendientes += [m.group(2) for m in PATRON_URL_RECURSO_CSS.finditer(texto.decode('utf-8'))]
+        if url in cache:
+            continue
+        total += len(cuerpo)
+        if 'immutable' in respuesta.headers.get('Cache-Control', ''):
+            cache.add(url)
+    return total
+
+
+@app.cli.command('benchmark-estaticos')
+@click.option('--vistas', default=5, help='Vistas consecutivas de cada página.')
+def benchmark_estaticos(vistas):
+    """Bytes de estáticos por vista, con los archivos originales y con static/dist."""
+    global _manifiesto_estaticos
+    paginas = ['/', '/Comida']
+    manifiesto = cargar_manifiesto_estaticos() or construir_estaticos()
+    cliente = app.test_client()
+    for nombre, activo in (('antes', {}), ('después', manifiesto)):
+        _manifiesto_estaticos = activo
+        for pagina in paginas:
+            cache = set()
+            por_vista = [_bytes_vista(cliente, pagina, cache) for _ in range(vistas)]
+            click.echo(f"{nombre:8} {pagina:8} primera vista {por_vista[0] / 1024:8.1f} KiB, "
+                       f"siguientes {sum(por_vista[1:]) / max(vistas - 1, 1) / 1024:8.1f} KiB/vista, "
+                       f"total {vistas} vistas {sum(por_vista) / 1024:8.1f} KiB")
+    _manifiesto_estaticos = manifiesto
+
+
 @app.after_request
 def add_header(response):
+    if request.endpoint == 'asset_inmutable':
+        return response
     response.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, private, max-age=0"
     response.headers["Pragma"] = "no-cache"
     response.headers["Expires"] = "0"
@@ -592,12 +1601,39 @@ def chiaentre():
     role = session.get('role')
     return render_template('Base/Home.html', username=username, role=role)
 
+def asegurar_columnas():
+    """Agrega columnas e índices nuevos a tablas existentes (db.create_all no altera tablas)."""
+    inspector = db.inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+    with db.engine.begin() as conn:
+        for tabla in db.metadata.sorted_tables:
+            if not inspector.has_table(tabla.name):
+                continue
+            existentes = {c['name'] for c in inspector.get_columns(tabla.name)}
+            for columna in tabla.columns:
+                if columna.name not in existentes:
+                    tipo = columna.type.compile(dialect=db.engine.dialect)
+                    defecto = f" DEFAULT {columna.server_default.arg}" if columna.server_default is not None else ""
+                    conn.execute(text(
+                        f"ALTER TABLE {preparer.quote(tabla.name)} ADD COLUMN {preparer.quote(columna.name)} {tipo}{defecto}"
+                    ))
+            for indice in tabla.indexes:
+                # IF NOT EXISTS en vez de checkfirst: la reflexión no ve los índices sobre expresiones
+                conn.execute(CreateIndex(indice, if_not_exists=True))
+
+def sembrar_preferencias():
+    """Crea las filas del catálogo de preferencias que falten."""
+    existentes = {p_id for (p_id,) in db.session.query(Preferencia.id)}
+    for p_id, nombre in enumerate(PREFERENCIAS):
+        if p_id not in existentes:
+            db.session.add(Preferencia(id=p_id, nombre=nombre))
+    db.session.commit()
+
 with app.app_context():
     db.create_all()
+    asegurar_columnas()
+    sembrar_preferencias()
         
-if __name__ == '__main__':
-    app.run(debug=True)
-
 
 # -------------------------------------------------------------------------------------------------------------------------------------------------------------------
 from collections import Counter
@@ -608,53 +1644,26 @@ def admin_dashboard():
         flash("Tu sesión ha expirado. Inicia sesión nuevamente.", "warning")
         return redirect(url_for('login'))
     
-    # Totales generales
-    total_usuarios = User.query.count()
-    total_exploradores = User.query.filter(func.lower(User.role) == 'explorador').count()
-    total_emprendedores = User.query.filter(func.lower(User.role) == 'emprendedor').count()
     username = session.get('username')
     role = session.get('role')
 
-    # Datos para la gráfica de roles
-    roles_data = {
-        'Exploradores': total_exploradores,
-        'Emprendedores': total_emprendedores
-    }
-    
-    # --- Datos para exploradores ---
-    exploradores = Explorador.query.all()
-
-    # --- Datos para emprendedores ---
-    empresa = Empresa.query.all()
-    emprendedores = Emprendedor.query.all()
-    planes_posibles = ['Sin Plan','Valvanera', 'Castillo Marroquin', 'Diosa Chia']
-
-    logs = LogAccion.query.order_by(LogAccion.fecha.desc()).all()
+    # Las tablas de empresas, exploradores y auditoría se piden paginadas a /api/admin/tabla/<nombre>;
+    # los totales y gráficas los deja listos el trabajo 'agregados-admin'
+    agregados = leer_agregado('admin', 3 * INTERVALO_AGREGADOS_ADMIN) or calcular_agregados_admin()
+    total_usuarios = agregados['total_usuarios']
+    total_exploradores = agregados['roles']['Exploradores']
+    total_emprendedores = agregados['roles']['Emprendedores']
+    roles_data = agregados['roles']
 
-    # Contar cuántos emprendedores hay por plan
-    planes = [e.plan if e.plan in planes_posibles else 'Sin plan' for e in empresa]
-    plan_counts = Counter(planes)
-
-    labels_plan = planes_posibles
-    values_plan = [plan_counts.get(p, 0) for p in labels_plan]
+    labels_plan = PLANES_POSIBLES
+    values_plan = agregados['planes']
 
     # --- Gráfica de preferencias (Exploradores) ---
-    preferencias_posibles = ['Comida', 'Deportes', 'Ocio', 'Arte y Cultura', 'Naturaleza', 'Compras']
-    preferencias = [exp.preferencias for exp in exploradores if exp.preferencias in preferencias_posibles]
-    preferencias_count = Counter(preferencias)
+    labels_pref = PREFERENCIAS
+    values_pref = agregados['preferencias']
 
-    labels_pref = preferencias_posibles
-    values_pref = [preferencias_count.get(p, 0) for p in labels_pref]
-
-    acciones_labels = ['Creación', 'Edición', 'Eliminación']
-
-    conteo_acciones = {
-        'Creación': db.session.query(func.count(LogAccion.id)).filter(LogAccion.accion.like('%Creación%')).scalar(),
-        'Edición': db.session.query(func.count(LogAccion.id)).filter(LogAccion.accion.like('%Edición%')).scalar(),
-        'Eliminación': db.session.query(func.count(LogAccion.id)).filter(LogAccion.accion.like('%Eliminación%')).scalar()
-    }
-
-    acciones_values = [conteo_acciones[label] for label in acciones_labels]
+    acciones_labels = ACCIONES_AUDITORIA
+    acciones_values = agregados['acciones']
 
     return render_template(
         'Base/dashboard_admin.html',
@@ -662,20 +1671,327 @@ def admin_dashboard():
         total_exploradores=total_exploradores,
         total_emprendedores=total_emprendedores,
         roles_data=roles_data,
-        emprendedores=emprendedores,
-        empresa=empresa,
-        exploradores=exploradores,
         labels_plan=labels_plan,
         values_plan=values_plan,
         labels_pref=labels_pref,
         values_pref=values_pref,
-        logs=logs,
         acciones_labels=acciones_labels,
         acciones_values=acciones_values,
         role=role,
         username=username
     )
 
+PLANES_POSIBLES = ['Sin Plan', 'Valvanera', 'Castillo Marroquin', 'Diosa Chia']
+ACCIONES_AUDITORIA = ['Creación', 'Edición', 'Eliminación']
+
+def calcular_agregados_admin():
+    """Totales y series de las gráficas del panel de administración."""
+    roles = dict(db.session.query(func.lower(User.role), func.count(User.id)).group_by(func.lower(User.role)))
+
+    # Contar cuántos emprendedores hay por plan
+    plan_counts = Counter()
+    for plan, total in db.session.query(Empresa.plan, func.count(Empresa.id)).group_by(Empresa.plan):
+        plan_counts[plan if plan in PLANES_POSIBLES else 'Sin Plan'] += total
+
+    # Un solo recorrido de la auditoría para las tres acciones
+    conteo_acciones = db.session.query(*(
+        func.count(db.case((LogAccion.accion.like(f'%{accion}%'), 1))) for accion in ACCIONES_AUDITORIA
+    )).one()
+
+    return {
+        'total_usuarios': sum(roles.values()),
+        'roles': {
+            'Exploradores': roles.get('explorador', 0),
+            'Emprendedores': roles.get('emprendedor', 0)
+        },
+        'planes': [plan_counts.get(p, 0) for p in PLANES_POSIBLES],
+        'preferencias': contar_preferencias(),
+        'acciones': list(conteo_acciones)
+    }
+
+# --- Tablas del panel de administración: búsqueda, orden y paginación por cursor (keyset) ---
+TAMANO_PAGINA_ADMIN = 25
+
+TABLAS_ADMIN = {
+    'empresas': {
+        'columnas': {
+            'id': Empresa.id,
+            'nombre_emprendimiento': Empresa.nombre_emprendimiento,
+            'nit': Empresa.nit,
+            'zona': Empresa.zona,
+            'ubicacion': Empresa.ubicacion,
+            'plan': Empresa.plan,
+            'clasificacion': Empresa.clasificacion,
+            'emprendedor_id': Empresa.emprendedor_id,
+        },
+        'clave': Empresa.id,
+        'orden': ['id', 'nombre_emprendimiento', 'nit', 'zona', 'plan', 'clasificacion'],
+        'busqueda': ['nombre_emprendimiento', 'nit', 'zona', 'clasificacion'],
+        'orden_defecto': ('id', 'asc'),
+    },
+    'emprendedores': {
+        'columnas': {
+            'id': Emprendedor.id,
+            'primer_nombre': Emprendedor.primer_nombre,
+            'primer_apellido': Emprendedor.primer_apellido,
+            'telefono': Emprendedor.telefono,
+            'username': User.username,
+        },
+        'joins': [(User, User.id == Emprendedor.user_id)],
+        'clave': Emprendedor.id,
+        'orden': ['id', 'primer_nombre', 'primer_apellido', 'username'],
+        'busqueda': ['primer_nombre', 'primer_apellido', 'username', 'telefono'],
+        'orden_defecto': ('id', 'asc'),
+    },
+    'exploradores': {
+        'columnas': {
+            'id': Explorador.id,
+            'primer_nombre': Explorador.primer_nombre,
+            'segundo_nombre': Explorador.segundo_nombre,
+            'primer_apellido': Explorador.primer_apellido,
+            'segundo_apellido': Explorador.segundo_apellido,
+            'telefono': Explorador.telefono,
+            'preferencias': Explorador.preferencias,
+            'fecha_nacimiento': Explorador.fecha_nacimiento,
+        },
+        'clave': Explorador.id,
+        'orden': ['id', 'primer_nombre', 'primer_apellido', 'telefono', 'preferencias'],
+        'busqueda': ['primer_nombre', 'primer_apellido', 'telefono', 'preferencias'],
+        'orden_defecto': ('id', 'asc'),
+    },
+    'auditoria': {
+        'columnas': {
+            'id': LogAccion.id,
+            'fecha': LogAccion.fecha,
+            'usuario': User.username,
+            'accion': LogAccion.accion,
+            'entidad_id': LogAccion.entidad_id,
+            'detalles': LogAccion.detalles,
+        },
+        'joins': [(User, User.id == LogAccion.user_id)],
+        'clave': LogAccion.id,
+        'orden': ['id', 'fecha', 'accion'],
+        'busqueda': ['accion', 'detalles', 'usuario'],
+        'orden_defecto': ('fecha', 'desc'),
+    },
+}
+
+def _expresion_orden(columna):
+    # Los textos se comparan con COALESCE para que los NULL entren en el cursor
+    return orden_texto(columna) if isinstance(columna.type, db.String) else columna
+
+def _serializar_valor(valor):
+    if isinstance(valor, datetime):
+        return valor.isoformat(sep=' ')
+    if isinstance(valor, date):
+        return valor.isoformat()
+    return valor
+
+def _entero_sql(valor):
+    # bool es subclase de int; los enteros fuera de 64 bits no caben en la columna
+    if isinstance(valor, bool) or not isinstance(valor, int) or not -2 ** 63 <= valor < 2 ** 63:
+        raise ValueError(f"Entero no válido: {valor!r}")
+    return valor
+
+def _leer_cursor(cursor, columna):
+    """El cursor es [valor de la columna de orden, id] de la última fila de la página anterior.
+    Lanza ValueError si el valor no corresponde al tipo de la columna."""
+    datos = json.loads(cursor)
+    if not isinstance(datos, list) or len(datos) != 2:
+        raise ValueError("El cursor debe ser [valor, id]")
+    valor, ultimo_id = datos
+    if isinstance(columna.type, db.String):
+        if not isinstance(valor, str):
+            raise ValueError(f"Texto no válido: {valor!r}")
+    elif isinstance(columna.type, db.DateTime):
+        valor = datetime.fromisoformat(valor)
+    else:
+        valor = _entero_sql(valor)
+    return valor, _entero_sql(ultimo_id)
+
+@app.route('/api/admin/tabla/<string:nombre>')
+def tabla_admin(nombre):
+    if 'user_id' not in session or session.get('role') != 'Administrador':
+        return jsonify({'error': 'No autorizado'}), 403
+
+    tabla = TABLAS_ADMIN.get(nombre)
+    if not tabla:
+        return jsonify({'error': 'Tabla no encontrada'}), 404
+
+    columnas = tabla['columnas']
+    campo, direccion = tabla['orden_defecto']
+    campo = request.args.get('orden', campo)
+    direccion = request.args.get('dir', direccion)
+    if campo not in tabla['orden'] or direccion not in ('asc', 'desc'):
+        return jsonify({'error': 'Orden no válido'}), 400
+    limite = max(1, min(request.args.get('limite', TAMANO_PAGINA_ADMIN, type=int), 100))
+
+    orden = _expresion_orden(columnas[campo])
+    clave = tabla['clave']
+    consulta = db.session.query(*columnas.values())
+    for modelo, condicion in tabla.get('joins', []):
+        consulta = consulta.outerjoin(modelo, condicion)
+
+    busqueda = request.args.get('q', '').strip()
+    if busqueda:
+        patron = f"%{busqueda}%"
+        consulta = consulta.filter(db.or_(*(columnas[c].ilike(patron) for c in tabla['busqueda'])))
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            valor, ultimo_id = _leer_cursor(cursor, columnas[campo])
+        except (ValueError, TypeError, OverflowError):
+            return jsonify({'error': 'Cursor no válido'}), 400
+        if direccion == 'asc':
+            consulta = consulta.filter(db.or_(orden > valor, db.and_(orden == valor, clave > ultimo_id)))
+        else:
+            consulta = consulta.filter(db.or_(orden < valor, db.and_(orden == valor, clave < ultimo_id)))
+
+    if direccion == 'asc':
+        consulta = consulta.order_by(orden.asc(), clave.asc())
+    else:
+        consulta = consulta.order_by(orden.desc(), clave.desc())
+
+    filas = consulta.limit(limite + 1).all()
+    hay_mas = len(filas) > limite
+    items = [{c: _serializar_valor(v) for c, v in zip(columnas, fila)} for fila in filas[:limite]]
+    if nombre == 'exploradores':
+        anotar_segmentos(items)
+
+    siguiente = None
+    if hay_mas:
+        ultimo = items[-1]
+        valor = ultimo[campo]
+        if valor is None and isinstance(columnas[campo].type, db.String):
+            valor = ''
+        siguiente = json.dumps([valor, ultimo['id']])
+
+    return jsonify({'items': items, 'siguiente': siguiente})
+
+# -------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Preferencias de los exploradores (máscara de bits + tabla explorador_preferencia)
+
+def parsear_preferencias(valores):
+    """Convierte textos libres ("Comida, Cultura", ["Ocio"]) en ids ordenados del catálogo."""
+    if isinstance(valores, str):
+        valores = [valores]
+    por_nombre = {normalizar_texto(nombre): p_id for p_id, nombre in enumerate(PREFERENCIAS)}
+    for sinonimo, nombre in SINONIMOS_PREFERENCIA.items():
+        por_nombre[sinonimo] = PREFERENCIAS.index(nombre)
+
+    ids = set()
+    for valor in valores:
+        for parte in (valor or '').replace(';', ',').replace('/', ',').replace('|', ',').split(','):
+            p_id = por_nombre.get(normalizar_texto(parte))
+            if p_id is not None:
+                ids.add(p_id)
+    return sorted(ids)
+
+def mascara_preferencias(ids):
+    return sum(1 << p_id for p_id in ids)
+
+def nombres_preferencias(mascara):
+    return [nombre for p_id, nombre in enumerate(PREFERENCIAS) if (mascara or 0) >> p_id & 1]
+
+def asignar_preferencias(explorador, ids):
+    """Sincroniza máscara, texto legible y filas de explorador_preferencia."""
+    explorador.preferencias_mask = mascara_preferencias(ids)
+    explorador.preferencias = ', '.join(PREFERENCIAS[p_id] for p_id in ids)
+
+    actuales = {ep.preferencia_id: ep for ep in explorador.preferencias_explorador}
+    for p_id, ep in actuales.items():
+        if p_id not in ids:
+            explorador.preferencias_explorador.remove(ep)
+    for p_id in ids:
+        if p_id not in actuales:
+            explorador.preferencias_explorador.append(ExploradorPreferencia(preferencia_id=p_id))
+
+def contar_preferencias():
+    """Exploradores por preferencia (en el orden de PREFERENCIAS) con un GROUP BY indexado."""
+    conteo = dict(db.session.query(ExploradorPreferencia.preferencia_id, func.count())
+                  .group_by(ExploradorPreferencia.preferencia_id))
+    return [conteo.get(p_id, 0) for p_id in range(len(PREFERENCIAS))]
+
+def consulta_exploradores_con_preferencias(ids):
+    """Subconsulta de ids de exploradores que tienen TODAS las preferencias indicadas."""
+    return db.session.query(ExploradorPreferencia.explorador_id)\
+        .filter(ExploradorPreferencia.preferencia_id.in_(ids))\
+        .group_by(ExploradorPreferencia.explorador_id)\
+        .having(func.count() == len(ids))
+
+@app.route('/api/exploradores/preferencias')
+def exploradores_por_preferencias():
+    if 'user_id' not in session or session.get('role') != 'Administrador':
+        return jsonify({'error': 'No autorizado'}), 403
+
+    ids = parsear_preferencias(request.args.getlist('incluye'))
+    if not ids:
+        return jsonify({'error': 'Indica al menos una preferencia válida en "incluye".'}), 400
+
+    subconsulta = consulta_exploradores_con_preferencias(ids).subquery()
+    total = db.session.query(func.count()).select_from(subconsulta).scalar()
+    exploradores = db.session.query(Explorador.id, Explorador.primer_nombre, Explorador.primer_apellido, Explorador.preferencias)\
+        .filter(Explorador.id.in_(db.session.query(subconsulta.c.explorador_id)))\
+        .order_by(Explorador.id)\
+        .limit(100)
+
+    return jsonify({
+        'preferencias': [PREFERENCIAS[p_id] for p_id in ids],
+        'total': total,
+        'exploradores': [{
+            'id': e_id,
+            'nombre': f"{nombre or ''} {apellido or ''}".strip(),
+            'preferencias': preferencias
+        } for e_id, nombre, apellido, preferencias in exploradores]
+    })
+
+@app.route('/explorador/preferencias', methods=['POST'])
+def guardar_preferencias():
+    if 'user_id' not in session or session.get('role') != 'Explorador':
+        flash('Debes iniciar sesión como explorador.', 'warning')
+        return redirect(url_for('login'))
+
+    explorador = Explorador.query.filter_by(user_id=session['user_id']).first_or_404()
+    antes = explorador.preferencias
+    asignar_preferencias(explorador, parsear_preferencias(request.form.getlist('preferencias')))
+
+    log = LogAccion(
+        user_id=session['user_id'],
+        tipo_entidad='Explorador',
+        entidad_id=explorador.id,
+        accion='Edición de Preferencias',
+        detalles=f"preferencias: '{antes}' → '{explorador.preferencias}'"
+    )
+    db.session.add(log)
+    db.session.commit()
+
+    flash('Preferencias actualizadas.', 'success')
+    return redirect(url_for('explorador_dashboard'))
+
+@app.cli.command('migrar-preferencias')
+def migrar_preferencias():
+    """Convierte Explorador.preferencias (texto libre) a máscara de bits + tabla explorador_preferencia."""
+    sin_reconocer = []
+    exploradores = Explorador.query.all()
+    for explorador in exploradores:
+        ids = parsear_preferencias(explorador.preferencias)
+        if explorador.preferencias and not ids:
+            sin_reconocer.append(f"{explorador.id} ({explorador.preferencias!r})")
+            continue
+        asignar_preferencias(explorador, ids)
+    db.session.commit()
+
+    click.echo(f"Exploradores migrados: {len(exploradores) - len(sin_reconocer)}")
+    if sin_reconocer:
+        click.echo(f"Sin preferencias reconocidas (se dejaron igual): {', '.join(sin_reconocer)}")
+
+@app.route('/api/limites')
+def estadisticas_limites():
+    if 'user_id' not in session or session.get('role') != 'Administrador':
+        return jsonify({'error': 'No autorizado'}), 403
+    return jsonify(limitador.estadisticas())
+
 # --- Ver detalles de un emprendimiento ---
 @app.route('/emprendimiento/<int:id>')
 def ver_emprendimiento(id):
@@ -697,6 +2013,8 @@ def eliminar_emprendimiento(id):
 
     for empresa in emprendimiento.empresas:
         db.session.delete(empresa)
+    invalidar_indice_empresas()
+    tablero_tendencias.invalidar()
 
     # Registrar en auditoría antes de eliminar
     log = LogAccion(
@@ -735,9 +2053,14 @@ def editar_emprendimiento(id):
     e.ubicacion = request.form.get('ubicacion', e.ubicacion)
     e.plan = request.form.get('plan', e.plan)
     e.clasificacion = request.form.get('clasificacion', e.clasificacion)
+    if e.zona != datos_antes['zona']:
+        geocodificar_empresa(e, forzar=True)
 
     # Guardar cambios
     db.session.commit()
+    invalidar_indice_empresas()
+    tablero_tendencias.invalidar()
+    invalidar_dashboard(e.id)
 
     # Comparar y generar detalle de los cambios
     cambios = []
@@ -858,17 +2181,26 @@ def explorador_dashboard():
     favoritos = Favorito.query.filter_by(explorador_id=explorador.id)\
         .order_by(Favorito.fecha_guardado.desc()).all()
     
-    return render_template('Explorador/dashboard_explorador.html', user=user, favoritos=favoritos, explorador=explorador)
+    return render_template('Explorador/dashboard_explorador.html', user=user, favoritos=favoritos, explorador=explorador,
+                           catalogo_preferencias=PREFERENCIAS,
+                           mis_preferencias=nombres_preferencias(explorador.preferencias_mask))
 
 # Ruta para recomendar un lugar por categoría
 @app.route('/recomendar/<categoria>')
 def recomendar_lugar(categoria):
-    from random import choice
-    lugares = Empresa.query.filter(Empresa.clasificacion.ilike(f'%{categoria}%')).all()
-    if not lugares:
-        return jsonify({'error': 'No hay lugares en esta categoría'}), 404
-
-    lugar = choice(lugares)
+    # Sorteo entre el top de tendencias, con probabilidad proporcional al puntaje (+1 para no excluir las nuevas)
+    clave = normalizar_texto(categoria)
+    ahora = datetime.utcnow()
+    candidatos = [par for c in tablero_tendencias.categorias() if clave in c for par in tablero_tendencias.top(c)]
+    lugar = None
+    if candidatos:
+        pesos = [max(puntaje_actual(p, ahora), 0) + 1 for _, p in candidatos]
+        lugar = Empresa.query.get(random.choices(candidatos, weights=pesos)[0][0])
+    if lugar is None:
+        lugares = Empresa.query.filter(Empresa.clasificacion.ilike(f'%{categoria}%')).all()
+        if not lugares:
+            return jsonify({'error': 'No hay lugares en esta categoría'}), 404
+        lugar = random.choice(lugares)
     return jsonify({
         'nombre': lugar.nombre_emprendimiento,
         'descripcion': lugar.descripcion,
@@ -876,6 +2208,603 @@ def recomendar_lugar(categoria):
         'url': lugar.url or '#'
     })
 
+# -------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Segmentación de exploradores (predicción de preferencias)
+
+# Vector por explorador: edad, preferencias declaradas (7 bits), proporción de favoritos y de
+# visitas por categoría (7 + 7) y volumen de actividad (log de favoritos y visitas).
+# `flask entrenar-segmentos` ajusta k-means sobre todos los exploradores y guarda una versión
+# nueva en MODELOS_DIR; las peticiones usan el modelo más reciente ya cargado en memoria.
+# Por defecto es instance/modelos, local a cada máquina: con réplicas web en varios hosts debe
+# apuntar a un volumen compartido, o cada una solo verá los modelos entrenados en su host.
+DIR_MODELOS = os.getenv('MODELOS_DIR', os.path.join(app.instance_path, 'modelos'))
+SEGMENTOS_K = 6
+SEGMENTOS_REVISION_SEGUNDOS = 60
+N_PREF = len(PREFERENCIAS)
+COLUMNAS_SEGMENTOS = (['edad'] + [f'declara_{p}' for p in PREFERENCIAS] + [f'favoritos_{p}' for p in PREFERENCIAS]
+                      + [f'visitas_{p}' for p in PREFERENCIAS] + ['log_favoritos', 'log_visitas'])
+
+def construir_features(explorador_ids=None):
+    """(ids, X) con una fila por explorador; todo sale de tres consultas agrupadas."""
+    consulta = db.session.query(Explorador.id, Explorador.fecha_nacimiento, Explorador.preferencias_mask)
+    if explorador_ids is not None:
+        consulta = consulta.filter(Explorador.id.in_(explorador_ids))
+    filas = consulta.order_by(Explorador.id).all()
+    ids = np.array([f[0] for f in filas], dtype=np.int64)
+    fila_de = {e_id: i for i, e_id in enumerate(ids.tolist())}
+    X = np.zeros((len(ids), len(COLUMNAS_SEGMENTOS)))
+    if not len(ids):
+        return ids, X
+
+    hoy = date.today()
+    X[:, 0] = [(hoy - nacimiento).days / 365.25 if nacimiento else np.nan for _, nacimiento, _ in filas]
+    mascaras = np.array([mascara or 0 for _, _, mascara in filas], dtype=np.int64)
+    X[:, 1:1 + N_PREF] = (mascaras[:, None] >> np.arange(N_PREF)) & 1
+
+    pref_de_categoria = {}
+    for desplazamiento, modelo, columna in ((1 + N_PREF, Favorito, Favorito.explorador_id),
+                                            (1 + 2 * N_PREF, Visita, Visita.explorador_id)):
+        conteo = db.session.query(columna, Empresa.clasificacion, func.count())\
+            .join(Empresa, Empresa.id == modelo.empresa_id).filter(columna.isnot(None))
+        if explorador_ids is not None:
+            conteo = conteo.filter(columna.in_(explorador_ids))
+        for e_id, clasificacion, total in conteo.group_by(columna, Empresa.clasificacion):
+            if clasificacion not in pref_de_categoria:
+                pref_de_categoria[clasificacion] = (parsear_preferencias(clasificacion) or [None])[0]
+            p_id = pref_de_categoria[clasificacion]
+            if p_id is not None and e_id in fila_de:
+                X[fila_de[e_id], desplazamiento + p_id] += total
+
+    favoritos = X[:, 1 + N_PREF:1 + 2 * N_PREF].sum(axis=1)
+    visitas = X[:, 1 + 2 * N_PREF:1 + 3 * N_PREF].sum(axis=1)
+    X[:, 1 + N_PREF:1 + 2 * N_PREF] /= np.maximum(favoritos, 1)[:, None]
+    X[:, 1 + 2 * N_PREF:1 + 3 * N_PREF] /= np.maximum(visitas, 1)[:, None]
+    X[:, -2] = np.log1p(favoritos)
+    X[:, -1] = np.log1p(visitas)
+    return ids, X
+
+
+class ModeloSegmentos:
+    """Centroides de k-means más lo necesario para normalizar y describir cada segmento."""
+
+    def __init__(self, centroides, media, escala, perfiles, tamanos, meta):
+        self.centroides = centroides
+        self.media = media
+        self.escala = escala
+        self.perfiles = perfiles      # afinidad media por preferencia de cada segmento
+        self.tamanos = tamanos
+        self.meta = meta
+        self._norma_centroides = (centroides ** 2).sum(axis=1)
+
+    @classmethod
+    def entrenar(cls, X, k=SEGMENTOS_K, iteraciones=100, semilla=42):
+        rnd = np.random.default_rng(semilla)
+        media = np.nanmean(X, axis=0)
+        media = np.where(np.isnan(media), 0, media)
+        X = np.where(np.isnan(X), media, X)
+        escala = X.std(axis=0)
+        escala[escala == 0] = 1
+        Z = (X - media) / escala
+        k = min(k, len(Z))
+
+        # Inicialización k-means++
+        centroides = [Z[rnd.integers(len(Z))]]
+        d2 = ((Z - centroides[0]) ** 2).sum(axis=1)
+        for _ in range(1, k):
+            elegido = rnd.choice(len(Z), p=d2 / d2.sum()) if d2.sum() > 0 else rnd.integers(len(Z))
+            centroides.append(Z[elegido])
+            d2 = np.minimum(d2, ((Z - Z[elegido]) ** 2).sum(axis=1))
+        centroides = np.array(centroides)
+
+        asignacion = None
+        for _ in range(iteraciones):
+            distancias = (Z ** 2).sum(axis=1)[:, None] - 2 * Z @ centroides.T + (centroides ** 2).sum(axis=1)[None]
+            nueva = distancias.argmin(axis=1)
+            if asignacion is not None and np.array_equal(nueva, asignacion):
+                break
+            asignacion = nueva
+            for j in range(k):
+                miembros = Z[asignacion == j]
+                if len(miembros):
+                    centroides[j] = miembros.mean(axis=0)
+
+        tamanos = np.bincount(asignacion, minlength=k)
+        afinidad = (X[:, 1:1 + N_PREF] + X[:, 1 + N_PREF:1 + 2 * N_PREF] + X[:, 1 + 2 * N_PREF:1 + 3 * N_PREF]) / 3
+        perfiles = np.array([afinidad[asignacion == j].mean(axis=0) if tamanos[j] else np.zeros(N_PREF)
+                             for j in range(k)])
+        edades = [float(X[asignacion == j, 0].mean()) if tamanos[j] else 0.0 for j in range(k)]
+        meta = {'k': k, 'n': int(len(Z)), 'columnas': COLUMNAS_SEGMENTOS,
+                'preferencias': PREFERENCIAS, 'edades': edades}
+        return cls(centroides, media, escala, perfiles, tamanos, meta)
+
+    def predecir(self, X):
+        """Segmento de cada fila de X, en una sola operación matricial."""
+        X = np.where(np.isnan(X), self.media, X)
+        Z = (X - self.media) / self.escala
+        distancias = -2 * Z @ self.centroides.T + self._norma_centroides[None]
+        return distancias.argmin(axis=1)
+
+    def describir(self, segmento):
+        orden = np.argsort(-self.perfiles[segmento])
+        predichas = [PREFERENCIAS[p] for p in orden[:3] if self.perfiles[segmento, p] > 0]
+        edad = self.meta['edades'][segmento]
+        nombre = ' + '.join(predichas[:2]) or 'Sin actividad'
+        return {
+            'segmento': int(segmento),
+            'nombre': f"{nombre} (~{edad:.0f} años)" if edad else nombre,
+            'preferencias_predichas': predichas,
+        }
+
+    def guardar(self):
+        os.makedirs(DIR_MODELOS, exist_ok=True)
+        version = max(versiones_modelo_segmentos(), default=0) + 1
+        self.meta.update(version=version, creado=datetime.utcnow().isoformat(timespec='seconds'))
+        ruta = os.path.join(DIR_MODELOS, f'segmentos-v{version:04d}.npz')
+        temporal = ruta + '.tmp.npz'
+        np.savez_compressed(temporal, centroides=self.centroides, media=self.media, escala=self.escala,
+                            perfiles=self.perfiles, tamanos=self.tamanos, meta=np.array(json.dumps(self.meta)))
+        os.replace(temporal, ruta)  # los workers nunca ven un archivo a medio escribir
+        return ruta
+
+    @classmethod
+    def cargar(cls, version):
+        with np.load(os.path.join(DIR_MODELOS, f'segmentos-v{version:04d}.npz')) as datos:
+            return cls(datos['centroides'], datos['media'], datos['escala'], datos['perfiles'],
+                       datos['tamanos'], json.loads(str(datos['meta'])))
+
+
+def versiones_modelo_segmentos():
+    try:
+        nombres = os.listdir(DIR_MODELOS)
+    except OSError:
+        return []
+    return [int(n[len('segmentos-v'):-len('.npz')]) for n in nombres
+            if n.startswith('segmentos-v') and n.endswith('.npz') and '.tmp' not in n]
+
+_modelo_segmentos = {'modelo': None, 'revisado': 0.0}
+
+def obtener_modelo_segmentos():
+    """Modelo más reciente, cargado una vez por proceso (revisa versiones nuevas cada minuto)."""
+    ahora = time.monotonic()
+    if ahora - _modelo_segmentos['revisado'] > SEGMENTOS_REVISION_SEGUNDOS:
+        _modelo_segmentos['revisado'] = ahora
+        version = max(versiones_modelo_segmentos(), default=None)
+        actual = _modelo_segmentos['modelo']
+        if version is not None and (actual is None or actual.meta['version'] != version):
+            _modelo_segmentos['modelo'] = ModeloSegmentos.cargar(version)
+    return _modelo_segmentos['modelo']
+
+def anotar_segmentos(items):
+    """Añade el segmento predicho a una página de exploradores (un solo lote)."""
+    modelo = obtener_modelo_segmentos()
+    if modelo is None or not items:
+        return
+    ids, X = construir_features([item['id'] for item in items])
+    descripciones = dict(zip(ids.tolist(), (modelo.describir(s) for s in modelo.predecir(X))))
+    for item in items:
+        item['segmento'] = descripciones.get(item['id'])
+
+@app.route('/api/admin/segmentos')
+def segmentos_exploradores():
+    if 'user_id' not in session or session.get('role') != 'Administrador':
+        return jsonify({'error': 'No autorizado'}), 403
+    modelo = obtener_modelo_segmentos()
+    if modelo is None:
+        return jsonify({'error': 'Aún no hay un modelo entrenado'}), 404
+    return jsonify({
+        'version': modelo.meta['version'],
+        'creado': modelo.meta['creado'],
+        'segmentos': [dict(modelo.describir(j), exploradores=int(modelo.tamanos[j]))
+                      for j in range(len(modelo.centroides))]
+    })
+
+@app.cli.command('entrenar-segmentos')
+@click.option('--k', default=SEGMENTOS_K, help='Número de segmentos.')
+def entrenar_segmentos(k):
+    """Entrena la segmentación con todos los exploradores y guarda una versión nueva."""
+    t0 = time.perf_counter()
+    ids, X = construir_features()
+    if not len(ids):
+        click.echo('No hay exploradores para entrenar.')
+        return
+    t_features = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    modelo = ModeloSegmentos.entrenar(X, k=k)
+    t_entrenamiento = time.perf_counter() - t0
+    ruta = modelo.guardar()
+
+    click.echo(f"Modelo v{modelo.meta['version']} guardado en {ruta}")
+    click.echo(f"{len(ids)} exploradores; features {t_features * 1000:.1f} ms, entrenamiento {t_entrenamiento * 1000:.1f} ms")
+    for j in range(len(modelo.centroides)):
+        click.echo(f"  {modelo.describir(j)['nombre']}: {modelo.tamanos[j]}")
+
+@app.cli.command('benchmark-segmentos')
+@click.option('--n', default=100000, help='Número de exploradores sintéticos.')
+@click.option('--k', default=SEGMENTOS_K)
+@click.option('--lote', default=50, help='Tamaño de lote (una página de la tabla del admin).')
+def benchmark_segmentos(n, k, lote):
+    """Mide entrenamiento y throughput de predicción, por lotes y fila a fila."""
+    rnd = np.random.default_rng(7)
+    X = np.zeros((n, len(COLUMNAS_SEGMENTOS)))
+    X[:, 0] = rnd.normal(21, 3, n)
+    X[:, 1:1 + N_PREF] = rnd.random((n, N_PREF)) < 0.3
+    for desplazamiento in (1 + N_PREF, 1 + 2 * N_PREF):
+        X[:, desplazamiento:desplazamiento + N_PREF] = rnd.dirichlet(np.ones(N_PREF), n)
+    X[:, -2:] = np.log1p(rnd.poisson(4, (n, 2)))
+
+    t0 = time.perf_counter()
+    modelo = ModeloSegmentos.entrenar(X, k=k)
+    click.echo(f"Entrenamiento ({n} exploradores, k={k}): {(time.perf_counter() - t0) * 1000:.0f} ms")
+
+    t0 = time.perf_counter()
+    for inicio in range(0, n, lote):
+        modelo.predecir(X[inicio:inicio + lote])
+    t_lotes = time.perf_counter() - t0
+
+    filas = min(n, 10000)
+    t0 = time.perf_counter()
+    for i in range(filas):
+        modelo.predecir(X[i:i + 1])
+    t_filas = (time.perf_counter() - t0) * n / filas
+
+    click.echo(f"Predicción en lotes de {lote}: {n / t_lotes:,.0f} exploradores/s")
+    click.echo(f"Predicción fila a fila: {n / t_filas:,.0f} exploradores/s ({t_filas / t_lotes:.0f}x más lento)")
+
+# -------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Tendencias por categoría
+
+# Cada visita/favorito suma peso·exp(λ·(t − época)) al puntaje de la empresa ("forward decay").
+# Como todos los puntajes decaen al mismo ritmo, basta con sumar al llegar el evento: el orden
+# relativo no cambia con el paso del tiempo y nunca hay que recorrer el historial.
+# Para que exp() no se desborde, la época avanza por periodos de VIDAS_MEDIAS_POR_PERIODO vidas
+# medias (~4,9 años con 7 días) y cada fila guarda respecto a qué periodo está su puntaje. El
+# primer evento de un periodo nuevo rebasa la fila en el mismo UPSERT (×2^-256); lo que tenga
+# dos o más periodos de antigüedad pesa menos de 2^-256 y se descarta.
+EPOCA_TENDENCIAS = datetime(2025, 1, 1)
+VIDA_MEDIA_TENDENCIA_HORAS = float(os.getenv('VIDA_MEDIA_TENDENCIA_HORAS', 7 * 24))
+LAMBDA_TENDENCIA = math.log(2) / (VIDA_MEDIA_TENDENCIA_HORAS * 3600)
+VIDAS_MEDIAS_POR_PERIODO = 256
+PERIODO_TENDENCIAS = timedelta(hours=VIDA_MEDIA_TENDENCIA_HORAS * VIDAS_MEDIAS_POR_PERIODO)
+REBASE_TENDENCIA = 2.0 ** -VIDAS_MEDIAS_POR_PERIODO
+PESO_VISITA = 1.0
+PESO_FAVORITO = 3.0
+TOP_TENDENCIAS = 20
+TENDENCIAS_TTL_SEGUNDOS = 60
+
+def periodo_tendencia(instante):
+    return math.floor((instante - EPOCA_TENDENCIAS) / PERIODO_TENDENCIAS)
+
+def factor_tendencia(instante, periodo):
+    """Peso de un evento en `instante`, relativo al inicio de `periodo` (a lo sumo 2^256)."""
+    inicio = EPOCA_TENDENCIAS + periodo * PERIODO_TENDENCIAS
+    return math.exp(LAMBDA_TENDENCIA * (instante - inicio).total_seconds())
+
+def rebasar_puntaje(puntaje, desde, hasta):
+    """Lleva un puntaje guardado respecto al periodo `desde` a la base del periodo `hasta`."""
+    if hasta <= desde:
+        return puntaje
+    return puntaje * REBASE_TENDENCIA if hasta == desde + 1 else 0.0
+
+def puntaje_actual(puntaje, ahora=None):
+    """Convierte un puntaje del periodo en curso en 'eventos equivalentes de hoy'."""
+    ahora = ahora or datetime.utcnow()
+    return puntaje / factor_tendencia(ahora, periodo_tendencia(ahora))
+
+
+class TableroTendencias:
+    """Top-N por categoría materializado en memoria.
+
+    Los eventos de este proceso se aplican al instante; lo que escriben otros
+    workers se recoge al recargar desde tendencia_empresa cada `ttl` segundos.
+    """
+
+    def __init__(self, top_n=TOP_TENDENCIAS, ttl=TENDENCIAS_TTL_SEGUNDOS):
+        self.top_n = top_n
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._puntajes = {}     # empresa_id -> puntaje
+        self._categoria = {}    # empresa_id -> categoría normalizada
+        self._miembros = defaultdict(set)
+        self._tops = {}         # categoría -> [(empresa_id, puntaje), ...] ordenado
+        self._periodo = None    # periodo de tendencia en que están expresados los puntajes
+        self._cargado = 0.0
+
+    def cargar(self):
+        periodo = periodo_tendencia(datetime.utcnow())
+        filas = db.session.query(Empresa.id, Empresa.clasificacion, TendenciaEmpresa.puntaje, TendenciaEmpresa.periodo)\
+            .outerjoin(TendenciaEmpresa, TendenciaEmpresa.empresa_id == Empresa.id).all()
+        with self._lock:
+            self._puntajes, self._categoria = {}, {}
+            self._miembros = defaultdict(set)
+            self._periodo = periodo
+            for empresa_id, clasificacion, puntaje, periodo_fila in filas:
+                categoria = normalizar_texto(clasificacion)
+                self._puntajes[empresa_id] = rebasar_puntaje(puntaje or 0.0, periodo_fila or 0, periodo)
+                self._categoria[empresa_id] = categoria
+                self._miembros[categoria].add(empresa_id)
+            self._tops = {categoria: self._ordenar(categoria) for categoria in self._miembros}
+            self._cargado = time.monotonic()
+
+    def invalidar(self):
+        self._cargado = 0.0
+
+    def _ordenar(self, categoria):
+        return [(empresa_id, self._puntajes[empresa_id]) for empresa_id in
+                heapq.nlargest(self.top_n, self._miembros[categoria], key=lambda e: (self._puntajes[e], -e))]
+
+    def _vigente(self):
+        if time.monotonic() - self._cargado > self.ttl or self._periodo != periodo_tendencia(datetime.utcnow()):
+            self.cargar()
+
+    def sumar(self, empresa_id, delta, periodo):
+        with self._lock:
+            categoria = self._categoria.get(empresa_id)
+            if categoria is None or periodo != self._periodo:
+                return  # empresa nueva o cambio de periodo: entra en la próxima recarga
+            puntaje = self._puntajes[empresa_id] = self._puntajes[empresa_id] + delta
+            top = self._tops[categoria]
+            en_top = any(e == empresa_id for e, _ in top)
+            if delta < 0 and en_top:
+                # Al bajar puede adelantarla una empresa que estaba fuera del top
+                self._tops[categoria] = self._ordenar(categoria)
+            elif en_top or len(top) < self.top_n or puntaje > top[-1][1]:
+                nuevo = [(e, p) for e, p in top if e != empresa_id] + [(empresa_id, puntaje)]
+                nuevo.sort(key=lambda item: (-item[1], item[0]))
+                self._tops[categoria] = nuevo[:self.top_n]
+
+    def top(self, categoria):
+        """Top-N ya ordenado de la categoría (lista materializada, sin recalcular)."""
+        self._vigente()
+        return self._tops.get(normalizar_texto(categoria), [])
+
+    def categorias(self):
+        self._vigente()
+        return list(self._tops)
+
+
+tablero_tendencias = TableroTendencias()
+
+def sumar_tendencia(empresa_id, peso, instante=None):
+    """Suma un evento al puntaje de la empresa dentro de la transacción en curso."""
+    ahora = datetime.utcnow()
+    periodo = periodo_tendencia(ahora)
+    delta = peso * factor_tendencia(instante or ahora, periodo)
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    puntaje = db.case(
+        (TendenciaEmpresa.periodo == periodo, TendenciaEmpresa.puntaje + delta),
+        (TendenciaEmpresa.periodo == periodo - 1, TendenciaEmpresa.puntaje * REBASE_TENDENCIA + delta),
+        else_=delta
+    )
+    db.session.execute(
+        insert(TendenciaEmpresa).values(empresa_id=empresa_id, puntaje=delta, periodo=periodo)
+        .on_conflict_do_update(index_elements=['empresa_id'],
+                               set_={'puntaje': puntaje, 'periodo': periodo})
+    )
+    tablero_tendencias.sumar(empresa_id, delta, periodo)
+
+@app.route('/api/tendencias/<string:categoria>')
+def tendencias_categoria(categoria):
+    ahora = datetime.utcnow()
+    return jsonify([{'empresa_id': empresa_id, 'puntaje': round(puntaje_actual(puntaje, ahora), 3)}
+                    for empresa_id, puntaje in tablero_tendencias.top(categoria)])
+
+@app.cli.command('recalcular-tendencias')
+def recalcular_tendencias():
+    """Reconstruye tendencia_empresa desde todo el historial de visitas y favoritos."""
+    periodo = periodo_tendencia(datetime.utcnow())
+    puntajes = defaultdict(float)
+    visitas = db.session.query(Visita.empresa_id, Visita.fecha).join(Empresa, Empresa.id == Visita.empresa_id)
+    for empresa_id, fecha in visitas:
+        puntajes[empresa_id] += PESO_VISITA * factor_tendencia(fecha or EPOCA_TENDENCIAS, periodo)
+    for empresa_id, fecha in db.session.query(Favorito.empresa_id, Favorito.fecha_guardado):
+        puntajes[empresa_id] += PESO_FAVORITO * factor_tendencia(fecha or EPOCA_TENDENCIAS, periodo)
+
+    TendenciaEmpresa.query.delete()
+    if puntajes:
+        db.session.execute(db.insert(TendenciaEmpresa),
+                           [{'empresa_id': e, 'puntaje': p, 'periodo': periodo} for e, p in puntajes.items()])
+    db.session.commit()
+    tablero_tendencias.invalidar()
+    click.echo(f"Puntajes recalculados: {len(puntajes)} empresas")
+
+# -------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Búsqueda "cerca de mí"
+
+# Centroides aproximados de las zonas/veredas de Chía (mismas opciones del formulario de registro)
+GAZETTEER_CHIA = {
+    'centro': (4.8617, -74.0587),
+    'el cerrito': (4.8720, -74.0400),
+    'delicias': (4.8550, -74.0450),
+    'campin': (4.8660, -74.0510),
+    'santa rita': (4.8680, -74.0660),
+    'tres esquinas': (4.8840, -74.0430),
+    'rio frio': (4.8900, -74.0750),
+    'el misterio': (4.8750, -74.0280),
+    'la estacion': (4.8570, -74.0620),
+    'fagua': (4.8920, -74.0210),
+    'yerbabuena': (4.8300, -74.0300),
+    'fonqueta': (4.8800, -74.0900),
+    'bojaca': (4.8450, -74.0700),
+}
+
+RADIO_TIERRA_KM = 6371.0
+KM_POR_GRADO = RADIO_TIERRA_KM * math.pi / 180
+RADIO_MAX_KM = 10
+INDICE_TTL_SEGUNDOS = 300
+
+def normalizar_texto(texto):
+    """'Río Frío ' -> 'rio frio' (sin tildes, minúsculas, sin espacios sobrantes)."""
+    sin_tildes = unicodedata.normalize('NFKD', texto or '').encode('ascii', 'ignore').decode('ascii')
+    return ' '.join(sin_tildes.lower().split())
+
+def geocodificar_empresa(empresa, forzar=False):
+    """Asigna latitud/longitud a partir de la zona usando el gazetteer local."""
+    if empresa.latitud is not None and not forzar:
+        return False
+    coordenadas = GAZETTEER_CHIA.get(normalizar_texto(empresa.zona))
+    if not coordenadas:
+        return False
+    empresa.latitud, empresa.longitud = coordenadas
+    return True
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 2 * RADIO_TIERRA_KM * math.asin(math.sqrt(a))
+
+class IndiceEspacial:
+    """Índice en cuadrícula: cada celda (~550 m) guarda las empresas que caen en ella,
+    separado por categoría para que el filtro no recorra otras clasificaciones."""
+
+    def __init__(self, tam_celda=0.005):
+        self.tam_celda = tam_celda
+        self.celdas = defaultdict(lambda: defaultdict(list))  # categoria -> celda -> [(id, lat, lon)]
+        self.total = 0
+
+    def _celda(self, lat, lon):
+        return int(math.floor(lat / self.tam_celda)), int(math.floor(lon / self.tam_celda))
+
+    def agregar(self, empresa_id, lat, lon, clasificacion):
+        celda = self._celda(lat, lon)
+        punto = (empresa_id, lat, lon)
+        self.celdas[None][celda].append(punto)
+        if clasificacion:
+            self.celdas[clasificacion.lower()][celda].append(punto)
+        self.total += 1
+
+    def cercanos(self, lat, lon, radio_km, categoria=None, limite=20):
+        """Devuelve [(distancia_km, empresa_id)] ordenado por distancia."""
+        celdas = self.celdas.get(categoria.lower() if categoria else None)
+        if not celdas:
+            return []
+
+        # Caja envolvente del radio; la longitud usa la latitud más alejada del ecuador
+        dlat = radio_km / KM_POR_GRADO
+        lat_extrema = min(abs(lat) + dlat, 89.9)
+        dlon = radio_km / (KM_POR_GRADO * math.cos(math.radians(lat_extrema)))
+        i0, j0 = self._celda(lat - dlat, lon - dlon)
+        i1, j1 = self._celda(lat + dlat, lon + dlon)
+
+        # Cerca de los polos la caja abarca muchísimas celdas vacías: se recorren las ocupadas
+        if (i1 - i0 + 1) * (j1 - j0 + 1) > len(celdas):
+            candidatas = [c for c in celdas if i0 <= c[0] <= i1 and j0 <= c[1] <= j1]
+        else:
+            candidatas = [(i, j) for i in range(i0, i1 + 1) for j in range(j0, j1 + 1)]
+
+        resultados = []
+        for celda in candidatas:
+            for empresa_id, e_lat, e_lon in celdas.get(celda, ()):
+                distancia = haversine_km(lat, lon, e_lat, e_lon)
+                if distancia <= radio_km:
+                    resultados.append((distancia, empresa_id))
+        return heapq.nsmallest(limite, resultados)
+
+# Índice por proceso; se reconstruye al invalidarse o cada INDICE_TTL_SEGUNDOS (otros workers)
+_indice_empresas = {'indice': None, 'construido': 0.0}
+
+def obtener_indice_empresas():
+    if _indice_empresas['indice'] is None or time.time() - _indice_empresas['construido'] > INDICE_TTL_SEGUNDOS:
+        indice = IndiceEspacial()
+        filas = db.session.query(Empresa.id, Empresa.latitud, Empresa.longitud, Empresa.clasificacion)\
+            .filter(Empresa.latitud.isnot(None), Empresa.longitud.isnot(None))
+        for empresa_id, lat, lon, clasificacion in filas:
+            indice.agregar(empresa_id, lat, lon, clasificacion)
+        _indice_empresas['indice'] = indice
+        _indice_empresas['construido'] = time.time()
+    return _indice_empresas['indice']
+
+def invalidar_indice_empresas():
+    _indice_empresas['indice'] = None
+
+@app.route('/api/cerca')
+def empresas_cercanas():
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    if lat is None or lon is None:
+        return jsonify({'error': 'Parámetros lat y lon requeridos'}), 400
+
+    radio_km = request.args.get('radio_km', 2.0, type=float)
+    if not all(map(math.isfinite, (lat, lon, radio_km))) \
+            or not (-90 <= lat <= 90 and -180 <= lon <= 180 and 0 < radio_km <= RADIO_MAX_KM):
+        return jsonify({'error': f'lat debe estar entre -90 y 90, lon entre -180 y 180 y radio_km entre 0 y {RADIO_MAX_KM}'}), 400
+    limite = max(1, min(request.args.get('limite', 20, type=int), 100))
+    categoria = request.args.get('categoria')
+
+    cercanos = obtener_indice_empresas().cercanos(lat, lon, radio_km, categoria, limite)
+    empresas = {e.id: e for e in Empresa.query.filter(Empresa.id.in_([e_id for _, e_id in cercanos]))} if cercanos else {}
+
+    return jsonify([{
+        'id': empresa_id,
+        'nombre': empresas[empresa_id].nombre_emprendimiento,
+        'clasificacion': empresas[empresa_id].clasificacion,
+        'zona': empresas[empresa_id].zona,
+        'imagen': empresas[empresa_id].imagen_filename,
+        'url': empresas[empresa_id].url or '#',
+        'distancia_km': round(distancia, 3)
+    } for distancia, empresa_id in cercanos if empresa_id in empresas])
+
+@app.cli.command('geocodificar-empresas')
+@click.option('--forzar', is_flag=True, help='Recalcula también las empresas que ya tienen coordenadas.')
+def geocodificar_empresas(forzar):
+    """Completa latitud/longitud de las empresas a partir de su zona."""
+    actualizadas, sin_zona = 0, []
+    for empresa in Empresa.query.all():
+        if geocodificar_empresa(empresa, forzar=forzar):
+            actualizadas += 1
+        elif empresa.latitud is None:
+            sin_zona.append(f"{empresa.id} ({empresa.zona!r})")
+    db.session.commit()
+    invalidar_indice_empresas()
+
+    click.echo(f"Empresas geocodificadas: {actualizadas}")
+    if sin_zona:
+        click.echo(f"Sin zona reconocida: {', '.join(sin_zona)}")
+
+@app.cli.command('benchmark-cercania')
+@click.option('--n', default=100000, help='Número de empresas sintéticas.')
+@click.option('--consultas', default=200, help='Número de consultas a medir.')
+@click.option('--radio-km', default=1.0)
+def benchmark_cercania(n, consultas, radio_km):
+    """Compara el índice en cuadrícula contra un recorrido Haversine completo."""
+    rnd = random.Random(42)
+    categorias = ['comida', 'ocio', 'deportes', 'cultura', 'naturaleza', 'compras']
+    puntos = [(i, rnd.uniform(4.82, 4.92), rnd.uniform(-74.10, -74.00), rnd.choice(categorias)) for i in range(n)]
+    origenes = [(rnd.uniform(4.82, 4.92), rnd.uniform(-74.10, -74.00)) for _ in range(consultas)]
+
+    t0 = time.perf_counter()
+    indice = IndiceEspacial()
+    for punto in puntos:
+        indice.agregar(*punto)
+    construccion = time.perf_counter() - t0
+
+    def recorrido_completo(lat, lon, categoria=None):
+        resultados = []
+        for empresa_id, e_lat, e_lon, clasif in puntos:
+            if categoria and clasif != categoria:
+                continue
+            distancia = haversine_km(lat, lon, e_lat, e_lon)
+            if distancia <= radio_km:
+                resultados.append((distancia, empresa_id))
+        return heapq.nsmallest(20, resultados)
+
+    for categoria in (None, 'comida'):
+        t0 = time.perf_counter()
+        con_indice = [indice.cercanos(lat, lon, radio_km, categoria) for lat, lon in origenes]
+        t_indice = (time.perf_counter() - t0) / consultas
+
+        t0 = time.perf_counter()
+        sin_indice = [recorrido_completo(lat, lon, categoria) for lat, lon in origenes]
+        t_scan = (time.perf_counter() - t0) / consultas
+
+        assert con_indice == sin_indice, 'El índice y el recorrido completo no coinciden'
+        click.echo(f"categoria={categoria or 'todas'}: índice {t_indice * 1000:.3f} ms/consulta, "
+                   f"recorrido {t_scan * 1000:.3f} ms/consulta ({t_scan / t_indice:.0f}x)")
+    click.echo(f"Construcción del índice ({n} empresas): {construccion * 1000:.1f} ms")
+
 
 
 @app.route('/eliminar_favorito/<int:fav_id>', methods=['POST'])
@@ -893,6 +2822,7 @@ def eliminar_favorito(fav_id):
         return redirect(url_for('explorador_dashboard'))
 
     db.session.delete(favorito)
+    sumar_tendencia(favorito.empresa_id, -PESO_FAVORITO, favorito.fecha_guardado)
     db.session.commit()
 
     empresa = Empresa.query.get(favorito.empresa_id)
@@ -907,26 +2837,123 @@ def eliminar_favorito(fav_id):
     )
     db.session.add(log)
     db.session.commit()
+    notificar_empresa(empresa.id, 'favoritos', {
+        'delta': -1,
+        'usuario': nombre_usuario,
+        'accion': 'Eliminación Favorito',
+        'fecha': datetime.utcnow().strftime("%Y-%m-%d %H:%M")
+    })
     flash('Lugar eliminado de tus favoritos.', 'success')
     return redirect(url_for('explorador_dashboard'))
 
+def consultar_auditoria_favoritos(empresa, limite=50):
+    """Registros de auditoría (LogAccion) de favoritos de esta empresa, con el usuario en el mismo JOIN."""
+    logs = db.session.query(LogAccion, User.username)\
+        .outerjoin(User, User.id == LogAccion.user_id)\
+        .filter(
+            LogAccion.tipo_entidad == 'Favorito',
+            LogAccion.detalles.like(f'%empresa {empresa.nombre_emprendimiento}%')
+        ).order_by(LogAccion.fecha.desc()).limit(limite).all()
+
+    return [{
+        'usuario': username or 'Desconocido',
+        'accion': log.accion,
+        'fecha': log.fecha.strftime("%Y-%m-%d %H:%M"),
+        'detalles': log.detalles
+    } for log, username in logs]
+
 @app.route('/api/auditoria_favoritos/<int:empresa_id>')
 def auditoria_favoritos(empresa_id):
     """Devuelve los registros de auditoría (LogAccion) relacionados con favoritos de esta empresa."""
-    logs = LogAccion.query.filter(
-        LogAccion.tipo_entidad == 'Favorito',
-        LogAccion.detalles.like(f'%empresa {Empresa.query.get(empresa_id).nombre_emprendimiento}%')
-    ).order_by(LogAccion.fecha.desc()).limit(50).all()
-
-    data = []
-    for log in logs:
-        data.append({
-            'usuario': log.user.username if log.user else 'Desconocido',
-            'accion': log.accion,
-            'fecha': log.fecha.strftime("%Y-%m-%d %H:%M"),
-            'detalles': log.detalles
-        })
-    return jsonify(data)
+    return jsonify(consultar_auditoria_favoritos(Empresa.query.get_or_404(empresa_id)))
+
+# -------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Métricas en vivo del emprendedor (Server-Sent Events)
+
+SSE_HEARTBEAT_SEGUNDOS = 15
+SSE_MAX_POR_EMPRESA = int(os.getenv('SSE_MAX_POR_EMPRESA', 5))
+SSE_MAX_TOTAL = int(os.getenv('SSE_MAX_TOTAL', 200))
+
+class CanalEventos:
+    """Pub/sub en memoria del proceso: cada conexión SSE tiene su propia cola.
+
+    Con gunicorn se debe usar un worker con hilos o gevent (queue/threading quedan
+    parcheados por gevent). Los eventos solo llegan a las conexiones del mismo proceso.
+    """
+
+    def __init__(self, max_por_empresa, max_total, tam_cola=100):
+        self.max_por_empresa = max_por_empresa
+        self.max_total = max_total
+        self.tam_cola = tam_cola
+        self._lock = threading.Lock()
+        self._suscriptores = defaultdict(set)
+        self._total = 0
+
+    def suscribir(self, empresa_id):
+        """Devuelve una cola nueva o None si se alcanzó algún límite de conexiones."""
+        with self._lock:
+            if self._total >= self.max_total or len(self._suscriptores[empresa_id]) >= self.max_por_empresa:
+                return None
+            cola = queue.Queue(maxsize=self.tam_cola)
+            self._suscriptores[empresa_id].add(cola)
+            self._total += 1
+            return cola
+
+    def desuscribir(self, empresa_id, cola):
+        with self._lock:
+            suscriptores = self._suscriptores.get(empresa_id)
+            if suscriptores and cola in suscriptores:
+                suscriptores.discard(cola)
+                self._total -= 1
+                if not suscriptores:
+                    del self._suscriptores[empresa_id]
+
+    def publicar(self, empresa_id, evento, datos):
+        with self._lock:
+            colas = list(self._suscriptores.get(empresa_id, ()))
+        for cola in colas:
+            try:
+                cola.put_nowait((evento, datos))
+            except queue.Full:
+                pass  # cliente lento: se descarta el delta, el panel se corrige al recargar
+
+canal_metricas = CanalEventos(SSE_MAX_POR_EMPRESA, SSE_MAX_TOTAL)
+
+def notificar_empresa(empresa_id, evento, datos):
+    """Invalida el panel cacheado de la empresa y envía el delta a sus conexiones SSE."""
+    invalidar_dashboard(empresa_id)
+    canal_metricas.publicar(empresa_id, evento, datos)
+
+@app.route('/api/stream/<int:empresa_id>')
+def stream_metricas(empresa_id):
+    user_id = session.get('user_id')
+    if not user_id or session.get('role') != 'Emprendedor':
+        return jsonify({'error': 'Debes iniciar sesión como emprendedor.'}), 403
+
+    es_propia = db.session.query(Empresa.id).join(Emprendedor, Empresa.emprendedor_id == Emprendedor.id)\
+        .filter(Empresa.id == empresa_id, Emprendedor.user_id == user_id).first()
+    if not es_propia:
+        return jsonify({'error': 'Empresa no encontrada.'}), 404
+
+    cola = canal_metricas.suscribir(empresa_id)
+    if cola is None:
+        return jsonify({'error': 'Demasiadas conexiones abiertas.'}), 429
+
+    def generar():
+        yield f"retry: {SSE_HEARTBEAT_SEGUNDOS * 1000}\n\n"
+        while True:
+            try:
+                evento, datos = cola.get(timeout=SSE_HEARTBEAT_SEGUNDOS)
+            except queue.Empty:
+                yield ": ping\n\n"  # heartbeat para proxies y para detectar desconexiones
+                continue
+            yield f"event: {evento}\ndata: {json.dumps(datos)}\n\n"
+
+    respuesta = Response(generar(), mimetype='text/event-stream')
+    respuesta.headers['X-Accel-Buffering'] = 'no'
+    # El servidor WSGI llama close() al desconectarse el cliente, aunque el generador no haya arrancado
+    respuesta.call_on_close(lambda: canal_metricas.desuscribir(empresa_id, cola))
+    return respuesta
 
 @app.route('/<string:categoria>')
 def comida(categoria):
@@ -935,12 +2962,325 @@ def comida(categoria):
     role = session.get('role')
     empresas = Empresa.query.filter(func.lower(Empresa.clasificacion) == categoria.lower()).all()
 
+    # Primero las empresas en tendencia; el resto conserva el orden de la consulta
+    ranking = {empresa_id: posicion for posicion, (empresa_id, puntaje)
+               in enumerate(tablero_tendencias.top(categoria)) if puntaje > 0}
+    empresas.sort(key=lambda e: ranking.get(e.id, len(ranking)))
+
     return render_template('Explorador/categoria.html',
                            categoria=categoria,
                            empresas=empresas,
+                           ranking=ranking,
                            username=username,
                            role=role)
 
 
 
 
+
+# -------------------------------------------------------------------------------------------------------------------------------------------------------------------
+# Trabajos en segundo plano
+
+# `flask trabajador` toma trabajos de la tabla `trabajo` y los ejecuta fuera de las peticiones.
+# Para reclamar uno se hace un UPDATE condicional (estado pendiente o lease vencido): si varias
+# réplicas compiten por la misma fila, solo una obtiene rowcount == 1. Mientras corre, un hilo
+# renueva el lease; si el worker muere, el lease vence y otro worker lo retoma.
+TRABAJO_LEASE_SEGUNDOS = 300
+TRABAJO_REINTENTO_SEGUNDOS = 30         # espera base antes de reintentar (se duplica en cada intento)
+TRABAJO_MAX_INTENTOS = 3
+TRABAJO_RETENCION_DIAS = 30
+INTERVALO_AGREGADOS_ADMIN = 5 * 60
+INTERVALO_VISITAS_EMPRESAS = 10 * 60
+
+TAREAS = {}
+
+def tarea(nombre, cada=None, lease=TRABAJO_LEASE_SEGUNDOS, max_intentos=TRABAJO_MAX_INTENTOS):
+    """Registra una función como tarea; con `cada` (segundos) se programa periódicamente."""
+    def registrar(funcion):
+        TAREAS[nombre] = {'funcion': funcion, 'cada': cada, 'lease': lease, 'max_intentos': max_intentos}
+        return funcion
+    return registrar
+
+def encolar_trabajo(nombre, cuando=None, **argumentos):
+    """Agrega un trabajo puntual a la sesión; se confirma junto con la transacción en curso."""
+    if nombre not in TAREAS:
+        raise ValueError(f"Tarea desconocida: {nombre}")
+    trabajo = Trabajo(nombre=nombre, argumentos=json.dumps(argumentos),
+                      programado_para=cuando or datetime.utcnow())
+    db.session.add(trabajo)
+    return trabajo
+
+def asegurar_trabajos_periodicos():
+    existentes = {n for (n,) in db.session.query(Trabajo.nombre).filter(Trabajo.periodico)}
+    for nombre, definicion in TAREAS.items():
+        if definicion['cada'] and nombre not in existentes:
+            db.session.add(Trabajo(nombre=nombre, periodico=True))
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()  # otro worker la creó al mismo tiempo
+
+def _disponible(ahora):
+    return db.and_(Trabajo.programado_para <= ahora, db.or_(
+        Trabajo.estado == 'pendiente',
+        db.and_(Trabajo.estado == 'en_curso', Trabajo.bloqueado_hasta < ahora)
+    ))
+
+def reclamar_trabajo(trabajador):
+    """Toma el trabajo vencido más antiguo; devuelve None si no hay ninguno libre."""
+    ahora = datetime.utcnow()
+    candidatos = db.session.query(Trabajo.id, Trabajo.nombre, Trabajo.estado, Trabajo.bloqueado_por)\
+        .filter(Trabajo.nombre.in_(list(TAREAS)), _disponible(ahora))\
+        .order_by(Trabajo.programado_para).limit(10).all()
+    for trabajo_id, nombre, estado, anterior in candidatos:
+        definicion = TAREAS[nombre]
+        resultado = db.session.execute(
+            db.update(Trabajo)
+            .where(Trabajo.id == trabajo_id, _disponible(ahora))
+            .values(estado='en_curso', bloqueado_por=trabajador, intentos=Trabajo.intentos + 1,
+                    bloqueado_hasta=ahora + timedelta(seconds=definicion['lease']))
+        )
+        db.session.commit()
+        if resultado.rowcount != 1:
+            continue
+        trabajo = db.session.get(Trabajo, trabajo_id)
+        if estado == 'en_curso':
+            # El worker anterior murió o se colgó (p. ej. sin memoria): ese intento cuenta como fallido
+            error = f"Lease vencido: {anterior} dejó de renovarlo"
+            trabajo.ultimo_error = error
+            if trabajo.intentos > definicion['max_intentos']:
+                cerrar_trabajo(trabajo, definicion, ahora, error)
+                db.session.commit()
+                continue
+            db.session.commit()
+        return trabajo
+    return None
+
+class LatidoTrabajo(threading.Thread):
+    """Renueva el lease de un trabajo en curso cada tercio de su duración.
+
+    Un fallo al renovar (conexión caída, "database is locked" en SQLite) no detiene el hilo:
+    reintenta cada pocos segundos. Si pasa un lease completo sin renovar, u otro worker ya
+    tomó el trabajo, marca `perdido` para que el resultado no se confirme dos veces.
+    """
+
+    REINTENTO_SEGUNDOS = 5
+
+    def __init__(self, engine, trabajo_id, trabajador, lease):
+        super().__init__(daemon=True)
+        self.engine = engine
+        self.trabajo_id = trabajo_id
+        self.trabajador = trabajador
+        self.lease = lease
+        self.perdido = threading.Event()
+        self.motivo = None
+        self._detener = threading.Event()
+
+    def run(self):
+        renovado = time.monotonic()
+        espera = self.lease / 3
+        while not self._detener.wait(espera):
+            try:
+                with self.engine.begin() as conn:
+                    resultado = conn.execute(
+                        db.update(Trabajo)
+                        .where(Trabajo.id == self.trabajo_id, Trabajo.bloqueado_por == self.trabajador)
+                        .values(bloqueado_hasta=datetime.utcnow() + timedelta(seconds=self.lease))
+                    )
+            except Exception:
+                app.logger.warning("No se pudo renovar el lease del trabajo %s", self.trabajo_id, exc_info=True)
+                if time.monotonic() - renovado >= self.lease:
+                    return self._perder(f"sin renovar el lease durante {self.lease} s")
+                espera = min(self.lease / 3, self.REINTENTO_SEGUNDOS)
+                continue
+            if resultado.rowcount != 1:
+                return self._perder("otro worker tomó el trabajo")
+            renovado, espera = time.monotonic(), self.lease / 3
+
+    def _perder(self, motivo):
+        app.logger.error("Trabajo %s perdido por %s: %s", self.trabajo_id, self.trabajador, motivo)
+        self.motivo = motivo
+        self.perdido.set()
+
+    def detener(self):
+        self._detener.set()
+        self.join()
+
+def ejecutar_trabajo(trabajo, trabajador):
+    """Corre la tarea, registra su duración y deja el trabajo reprogramado, terminado o fallido."""
+    definicion = TAREAS[trabajo.nombre]
+    trabajo_id, nombre = trabajo.id, trabajo.nombre
+    latido = LatidoTrabajo(db.engine, trabajo_id, trabajador, definicion['lease'])
+    latido.start()
+    inicio, t0 = datetime.utcnow(), time.perf_counter()
+    error = None
+    try:
+        definicion['funcion'](**json.loads(trabajo.argumentos or '{}'))
+        if latido.perdido.is_set():
+            raise RuntimeError(f"Lease perdido: {latido.motivo}")
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        error = traceback.format_exc()[-4000:]
+    finally:
+        latido.detener()
+    duracion_ms = (time.perf_counter() - t0) * 1000
+
+    db.session.add(EjecucionTrabajo(trabajo_id=trabajo_id, nombre=nombre, trabajador=trabajador,
+                                    inicio=inicio, duracion_ms=duracion_ms, ok=error is None, error=error))
+    trabajo = db.session.get(Trabajo, trabajo_id)
+    if trabajo is None or trabajo.bloqueado_por != trabajador:
+        db.session.commit()  # el lease venció y otro worker lo retomó: solo queda la ejecución
+        return error is None
+
+    cerrar_trabajo(trabajo, definicion, inicio, error)
+    db.session.commit()
+    return error is None
+
+def cerrar_trabajo(trabajo, definicion, inicio, error):
+    """Según el resultado del intento, reprograma el trabajo, lo da por terminado o por fallido."""
+    ahora = datetime.utcnow()
+    siguiente = inicio + timedelta(seconds=definicion['cada']) if trabajo.periodico else None
+    if error is None:
+        trabajo.ultimo_error = None
+        trabajo.estado, trabajo.intentos = ('pendiente', 0) if siguiente else ('ok', trabajo.intentos)
+    else:
+        trabajo.ultimo_error = error
+        if trabajo.intentos < definicion['max_intentos']:
+            trabajo.estado = 'pendiente'
+            siguiente = ahora + timedelta(seconds=TRABAJO_REINTENTO_SEGUNDOS * 2 ** (trabajo.intentos - 1))
+        elif siguiente:
+            trabajo.estado, trabajo.intentos = 'pendiente', 0   # se agotaron los reintentos: espera al próximo turno
+        else:
+            trabajo.estado = 'fallido'
+    if siguiente:
+        trabajo.programado_para = max(siguiente, ahora)
+    else:
+        trabajo.terminado = ahora
+    trabajo.bloqueado_por = trabajo.bloqueado_hasta = None
+
+def estadisticas_trabajos(ultimas=100):
+    """Por tarea: ejecuciones recientes, fallos, duración media y p95, y próxima ejecución."""
+    proximas = dict(db.session.query(Trabajo.nombre, func.min(Trabajo.programado_para))
+                    .filter(Trabajo.estado.in_(['pendiente', 'en_curso'])).group_by(Trabajo.nombre))
+    resumen = []
+    for nombre in sorted(set(TAREAS) | set(proximas)):
+        ejecuciones = db.session.query(EjecucionTrabajo.inicio, EjecucionTrabajo.duracion_ms, EjecucionTrabajo.ok)\
+            .filter(EjecucionTrabajo.nombre == nombre)\
+            .order_by(EjecucionTrabajo.inicio.desc()).limit(ultimas).all()
+        duraciones = sorted(d for _, d, _ in ejecuciones)
+        resumen.append({
+            'nombre': nombre,
+            'ejecuciones': len(ejecuciones),
+            'fallos': sum(not ok for _, _, ok in ejecuciones),
+            'media_ms': round(sum(duraciones) / len(duraciones), 1) if duraciones else None,
+            'p95_ms': round(duraciones[min(len(duraciones) - 1, int(len(duraciones) * 0.95))], 1) if duraciones else None,
+            'ultima': _serializar_valor(ejecuciones[0][0]) if ejecuciones else None,
+            'proxima': _serializar_valor(proximas.get(nombre)),
+        })
+    return resumen
+
+@app.route('/api/admin/trabajos')
+def api_trabajos():
+    if 'user_id' not in session or session.get('role') != 'Administrador':
+        return jsonify({'error': 'No autorizado'}), 403
+    return jsonify(estadisticas_trabajos())
+
+@app.cli.command('trabajador')
+@click.option('--una-vez', is_flag=True, help='Ejecuta los trabajos vencidos y termina.')
+@click.option('--espera', default=5.0, help='Segundos de espera cuando no hay trabajos.')
+def trabajador_cmd(una_vez, espera):
+    """Proceso worker: ejecuta los trabajos programados hasta recibir SIGTERM/SIGINT."""
+    trabajador = f"{socket.gethostname()}:{os.getpid()}"
+    detener = threading.Event()
+    for senal in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(senal, lambda *_: detener.set())  # termina el trabajo en curso antes de salir
+
+    click.echo(f"Trabajador {trabajador} iniciado ({', '.join(TAREAS)})")
+    while not detener.is_set():
+        asegurar_trabajos_periodicos()
+        trabajo = reclamar_trabajo(trabajador)
+        if trabajo is None:
+            if una_vez:
+                break
+            detener.wait(espera)
+            continue
+        nombre = trabajo.nombre
+        t0 = time.perf_counter()
+        ok = ejecutar_trabajo(trabajo, trabajador)
+        click.echo(f"{nombre}: {'ok' if ok else 'error'} en {(time.perf_counter() - t0) * 1000:.0f} ms")
+        db.session.remove()
+
+@app.cli.command('trabajos')
+def trabajos_cmd():
+    """Muestra las estadísticas de tiempos de cada tarea."""
+    for fila in estadisticas_trabajos():
+        click.echo(f"{fila['nombre']:22} ejecuciones={fila['ejecuciones']:<4} fallos={fila['fallos']:<3} "
+                   f"media={fila['media_ms']} ms p95={fila['p95_ms']} ms última={fila['ultima']} próxima={fila['proxima']}")
+
+# --- Resultados precalculados ---
+def guardar_agregado(clave, datos):
+    db.session.merge(AgregadoPrecalculado(clave=clave, datos=json.dumps(datos), calculado=datetime.utcnow()))
+
+def leer_agregado(clave, max_edad_segundos):
+    """Datos guardados por un trabajo, o None si no existen o tienen más de `max_edad_segundos`."""
+    fila = db.session.get(AgregadoPrecalculado, clave)
+    if fila is None or fila.calculado < datetime.utcnow() - timedelta(seconds=max_edad_segundos):
+        return None
+    return json.loads(fila.datos)
+
+# --- Tareas ---
+@tarea('agregados-admin', cada=INTERVALO_AGREGADOS_ADMIN)
+def precalcular_agregados_admin():
+    guardar_agregado('admin', calcular_agregados_admin())
+
+@tarea('visitas-empresas', cada=INTERVALO_VISITAS_EMPRESAS)
+def precalcular_visitas_empresas():
+    """Conteos por día de la semana y por semana de todas las empresas, con dos GROUP BY en total."""
+    hasta = datetime.utcnow()
+    _, inicio = ventana_semanas(hasta)
+    por_dia = defaultdict(lambda: [0] * 7)
+    por_semana = defaultdict(lambda: defaultdict(lambda: [0] * 7))
+
+    dow = db.extract('dow', Visita.fecha)
+    for empresa_id, dia, total in db.session.query(Visita.empresa_id, dow, func.count(Visita.id))\
+            .filter(Visita.empresa_id.isnot(None), Visita.fecha < hasta).group_by(Visita.empresa_id, dow):
+        if dia is not None:
+            por_dia[empresa_id][(int(dia) + 6) % 7] += total
+
+    dia_fecha = func.date(Visita.fecha)
+    for empresa_id, dia, total in db.session.query(Visita.empresa_id, dia_fecha, func.count(Visita.id))\
+            .filter(Visita.empresa_id.isnot(None), Visita.fecha >= inicio, Visita.fecha < hasta)\
+            .group_by(Visita.empresa_id, dia_fecha):
+        if isinstance(dia, str):  # SQLite devuelve la fecha como texto
+            dia = date.fromisoformat(dia)
+        por_semana[empresa_id][clave_semana(dia)][dia.weekday()] += total
+
+    calculado = datetime.utcnow()
+    filas = [{
+        'clave': f'visitas:{empresa_id}',
+        'datos': json.dumps({'hasta': hasta.isoformat(), 'dias': por_dia[empresa_id], 'semanas': por_semana[empresa_id]}),
+        'calculado': calculado
+    } for (empresa_id,) in db.session.query(Empresa.id)]
+    AgregadoPrecalculado.query.filter(AgregadoPrecalculado.clave.like('visitas:%')).delete(synchronize_session=False)
+    if filas:
+        db.session.execute(db.insert(AgregadoPrecalculado), filas)
+
+@tarea('entrenar-segmentos', cada=24 * 60 * 60, lease=30 * 60)
+def tarea_entrenar_segmentos():
+    # Escribe en MODELOS_DIR del worker que la toma: compartido con las réplicas web o en el mismo host
+    ids, X = construir_features()
+    if len(ids):
+        ModeloSegmentos.entrenar(X).guardar()
+
+@tarea('limpiar-ejecuciones', cada=24 * 60 * 60)
+def limpiar_ejecuciones():
+    limite = datetime.utcnow() - timedelta(days=TRABAJO_RETENCION_DIAS)
+    EjecucionTrabajo.query.filter(EjecucionTrabajo.inicio < limite).delete(synchronize_session=False)
+    Trabajo.query.filter(Trabajo.estado.in_(['ok', 'fallido']), Trabajo.terminado < limite)\
+        .delete(synchronize_session=False)
+
+
+# Debe ir al final: app.run() bloquea y lo que esté debajo no llegaría a definirse
+if __name__ == '__main__':
+    app.run(debug=True)
@@ -0,0 +1,80 @@
+import os
+import tempfile
+
+import pytest
+
+_db = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+os.environ['DATABASE_URL'] = f'sqlite:///{_db.name}'
+os.environ.setdefault('METRICAS_DIR', tempfile.mkdtemp())
+os.chdir(tempfile.mkdtemp())  # flask_session/ se crea en el directorio actual al importar la app
+
+from sqlalchemy import event
+
+import app as myiana
+from app import app, db, User, Explorador, Emprendedor, Empresa, Visita, SesionVisita
+
+
+@pytest.fixture
+def cliente():
+    with app.app_context():
+        motor = db.engine
+
+    # SQLite no valida llaves foráneas por defecto; PostgreSQL siempre lo hace
+    @event.listens_for(motor, 'connect')
+    def activar_llaves_foraneas(conexion, _):
+        conexion.execute('PRAGMA foreign_keys=ON')
+
+    motor.dispose()
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        myiana.sembrar_preferencias()
+    app.config['TESTING'] = True
+    yield app.test_client()
+    event.remove(motor, 'connect', activar_llaves_foraneas)
+
+
+def crear_datos():
+    """Un explorador con visitas y sesiones de visita en la empresa de un emprendedor."""
+    explorador_user = User(username='ana', email='ana@x.co', role='Explorador')
+    emprendedor_user = User(username='beto', email='beto@x.co', role='Emprendedor')
+    for user in (explorador_user, emprendedor_user):
+        user.set_password('x')
+    explorador = Explorador(user=explorador_user)
+    emprendedor = Emprendedor(user=emprendedor_user)
+    empresa = Empresa(nombre_emprendimiento='Arepas', nit='900', clasificacion='Comida', emprendedor=emprendedor)
+    db.session.add_all([explorador, emprendedor, empresa])
+    db.session.flush()
+    db.session.add_all([
+        Visita(empresa_id=empresa.id, explorador_id=explorador.id),
+        SesionVisita(explorador_id=explorador.id, empresa_id=empresa.id, inicio=myiana.datetime.utcnow(), segundos=30),
+    ])
+    db.session.commit()
+    return explorador.id, emprendedor.id
+
+
+def test_eliminar_explorador_con_visitas(cliente):
+    with app.app_context():
+        explorador_id, _ = crear_datos()
+
+    respuesta = cliente.post(f'/eliminar_explorador/{explorador_id}')
+
+    assert respuesta.status_code == 302
+    with app.app_context():
+        assert db.session.get(Explorador, explorador_id) is None
+        assert SesionVisita.query.count() == 0
+        visita = Visita.query.one()
+        assert visita.explorador_id is None and visita.empresa_id is not None
+
+
+def test_eliminar_emprendimiento_con_sesiones(cliente):
+    with app.app_context():
+        _, emprendedor_id = crear_datos()
+
+    respuesta = cliente.post(f'/eliminar_emprendimiento/{emprendedor_id}')
+
+    assert respuesta.status_code == 302
+    with app.app_context():
+        assert Empresa.query.count() == 0
+        assert SesionVisita.query.count() == 0
+        assert Visita.query.one().empresa_id is None